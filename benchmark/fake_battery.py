@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Synthetic com.victronenergy.battery.<name> service for the benchmark of dbus-mqtt-battery-sender.
+# Changes all values rate times per second. /Benchmark/Sent contains the time of the change,
+# so the time until the value arrives at the broker can be measured.
+
+from gi.repository import GLib  # pyright: ignore[reportMissingImports]
+import argparse
+import logging
+import os
+import random
+import sys
+from time import time
+from dbus.mainloop.glib import DBusGMainLoop  # pyright: ignore[reportMissingImports]
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "dbus-mqtt-battery-sender", "ext", "velib_python"))
+from vedbus import VeDbusService  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic battery service on the dbus")
+    parser.add_argument("--name", default="benchmark", help="battery path, the service is com.victronenergy.battery.<name>")
+    parser.add_argument("--cells", type=int, default=16, help="number of /Voltages/CellX and /Balances/CellX paths")
+    parser.add_argument("--rate", type=float, default=1.0, help="changes per second")
+    parser.add_argument("--batched", action="store_true", help="send one ItemsChanged per change instead of one PropertiesChanged per path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    DBusGMainLoop(set_as_default=True)
+
+    service = VeDbusService("com.victronenergy.battery." + args.name, register=False)
+    service.add_mandatory_paths(__file__, "1.0", "Benchmark", 100, 0xBA77, "Benchmark battery", "1.0", "1.0", 1)
+    service.add_path("/Dc/0/Power", 0.0)
+    service.add_path("/Dc/0/Voltage", 52.0)
+    service.add_path("/Dc/0/Current", 0.0)
+    service.add_path("/Dc/0/Temperature", 20.0)
+    service.add_path("/Soc", 50.0)
+    service.add_path("/Info/MaxChargeVoltage", 55.2)
+    service.add_path("/Info/MaxChargeCurrent", 100.0)
+    service.add_path("/Info/MaxDischargeCurrent", 100.0)
+    for cell in range(1, args.cells + 1):
+        service.add_path(f"/Voltages/Cell{cell}", 3.3)
+        service.add_path(f"/Balances/Cell{cell}", 0)
+    service.add_path("/Benchmark/Sent", time())
+    service.register()
+
+    def set_values(values):
+        values["/Dc/0/Current"] = round(random.uniform(-50, 50), 2)
+        values["/Dc/0/Voltage"] = round(random.uniform(51, 53), 2)
+        values["/Dc/0/Power"] = round(values["/Dc/0/Current"] * values["/Dc/0/Voltage"], 1)
+        values["/Soc"] = round(random.uniform(0, 100), 1)
+        for cell in range(1, args.cells + 1):
+            values[f"/Voltages/Cell{cell}"] = round(random.uniform(3.2, 3.4), 3)
+            values[f"/Balances/Cell{cell}"] = random.randint(0, 1)
+        # as last value, so the time includes all other changes
+        values["/Benchmark/Sent"] = time()
+
+    def update():
+        if args.batched:
+            with service as values:
+                set_values(values)
+        else:
+            set_values(service)
+        return True
+
+    GLib.timeout_add(max(1, int(1000 / args.rate)), update)
+    GLib.MainLoop().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# Minimal MQTT 3.1.1 and 5.0 broker stand-in for the benchmark of dbus-mqtt-battery-sender.
+# It accepts one or more publishers, acknowledges QoS 1 and 2, resolves topic aliases and passes
+# every received message with its receive time to on_message. Nothing is forwarded to subscribers.
+# With disconnect_every the connection is closed after that many publishes, to test the reconnect.
+# An unknown topic alias is a protocol error, it is counted and the connection is closed like a broker does.
+
+import socketserver
+import struct
+import threading
+from time import time
+
+CONNECT = 1
+PUBLISH = 3
+PUBREL = 6
+SUBSCRIBE = 8
+PINGREQ = 12
+DISCONNECT = 14
+
+# MQTT 5.0 property id -> type, only the properties a publisher can send
+PROPERTY_TYPES = {
+    0x01: "byte",  # PayloadFormatIndicator
+    0x02: "int4",  # MessageExpiryInterval
+    0x03: "string",  # ContentType
+    0x08: "string",  # ResponseTopic
+    0x09: "binary",  # CorrelationData
+    0x0B: "varint",  # SubscriptionIdentifier
+    0x11: "int4",  # SessionExpiryInterval
+    0x17: "byte",  # RequestProblemInformation
+    0x19: "byte",  # RequestResponseInformation
+    0x21: "int2",  # ReceiveMaximum
+    0x22: "int2",  # TopicAliasMaximum
+    0x23: "int2",  # TopicAlias
+    0x26: "pair",  # UserProperty
+    0x27: "int4",  # MaximumPacketSize
+}
+
+TOPIC_ALIAS = 0x23
+
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7F) << shift
+        if byte & 0x80 == 0:
+            return value, pos
+        shift += 7
+
+
+def encode_varint(value):
+    result = bytearray()
+    while True:
+        byte = value % 128
+        value //= 128
+        if value > 0:
+            byte |= 0x80
+        result.append(byte)
+        if value == 0:
+            return bytes(result)
+
+
+def read_string(data, pos):
+    length = struct.unpack_from("!H", data, pos)[0]
+    return data[pos + 2:pos + 2 + length], pos + 2 + length
+
+
+def read_properties(data, pos):
+    length, pos = read_varint(data, pos)
+    end = pos + length
+    properties = {}
+    while pos < end:
+        property_id, pos = read_varint(data, pos)
+        property_type = PROPERTY_TYPES[property_id]
+        if property_type == "byte":
+            value = data[pos]
+            pos += 1
+        elif property_type == "int2":
+            value = struct.unpack_from("!H", data, pos)[0]
+            pos += 2
+        elif property_type == "int4":
+            value = struct.unpack_from("!I", data, pos)[0]
+            pos += 4
+        elif property_type == "varint":
+            value, pos = read_varint(data, pos)
+        elif property_type == "pair":
+            key, pos = read_string(data, pos)
+            value, pos = read_string(data, pos)
+            value = (key, value)
+        else:
+            value, pos = read_string(data, pos)
+        properties[property_id] = value
+    return properties, end
+
+
+class MqttStandInHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.version = 4
+        # topic aliases are only valid for one connection
+        self.topic_aliases = {}
+        self.publishes = 0
+        self.file = self.request.makefile("rb")
+        with self.server.lock:
+            self.server.connections += 1
+        while True:
+            header = self.file.read(1)
+            if not header:
+                return
+
+            length = 0
+            shift = 0
+            while True:
+                byte = self.file.read(1)[0]
+                length += (byte & 0x7F) << shift
+                if byte & 0x80 == 0:
+                    break
+                shift += 7
+            data = self.file.read(length)
+
+            packet_type = header[0] >> 4
+            if packet_type == CONNECT:
+                self._handle_connect(data)
+            elif packet_type == PUBLISH:
+                if not self._handle_publish(header[0], data):
+                    return
+            elif packet_type == PUBREL:
+                # PUBCOMP
+                self.request.sendall(b"\x70\x02" + data[0:2])
+            elif packet_type == SUBSCRIBE:
+                self._handle_subscribe(data)
+            elif packet_type == PINGREQ:
+                self.request.sendall(b"\xd0\x00")
+            elif packet_type == DISCONNECT:
+                return
+
+    def _handle_connect(self, data):
+        _, pos = read_string(data, 0)
+        self.version = data[pos]
+        if self.version == 5:
+            # CONNACK with TopicAliasMaximum
+            properties = bytes([0x22]) + struct.pack("!H", 100)
+            body = b"\x00\x00" + encode_varint(len(properties)) + properties
+        else:
+            body = b"\x00\x00"
+        self.request.sendall(b"\x20" + encode_varint(len(body)) + body)
+
+    def _handle_publish(self, flags, data):
+        received = time()
+        qos = (flags >> 1) & 3
+        topic, pos = read_string(data, 0)
+        packet_id = None
+        if qos > 0:
+            packet_id = data[pos:pos + 2]
+            pos += 2
+
+        properties = {}
+        if self.version == 5:
+            properties, pos = read_properties(data, pos)
+
+        if TOPIC_ALIAS in properties:
+            if topic:
+                self.topic_aliases[properties[TOPIC_ALIAS]] = topic
+            elif properties[TOPIC_ALIAS] in self.topic_aliases:
+                topic = self.topic_aliases[properties[TOPIC_ALIAS]]
+            else:
+                with self.server.lock:
+                    self.server.protocol_errors += 1
+                return False
+        elif not topic:
+            with self.server.lock:
+                self.server.protocol_errors += 1
+            return False
+
+        self.server.on_message(topic.decode(), data[pos:], received, len(data) + 2)
+
+        if qos == 1:
+            # PUBACK
+            self.request.sendall(b"\x40\x02" + packet_id)
+        elif qos == 2:
+            # PUBREC
+            self.request.sendall(b"\x50\x02" + packet_id)
+
+        self.publishes += 1
+        # close the connection without DISCONNECT, the client keeps its unacknowledged messages
+        return not (self.server.disconnect_every and self.publishes >= self.server.disconnect_every)
+
+    def _handle_subscribe(self, data):
+        packet_id = data[0:2]
+        pos = 2
+        if self.version == 5:
+            _, pos = read_properties(data, pos)
+
+        # grant QoS 0 for every topic filter
+        granted = bytearray()
+        while pos < len(data):
+            _, pos = read_string(data, pos)
+            pos += 1
+            granted.append(0)
+
+        body = packet_id + (b"\x00" if self.version == 5 else b"") + bytes(granted)
+        self.request.sendall(b"\x90" + encode_varint(len(body)) + body)
+
+
+class MqttStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, on_message, host="127.0.0.1", port=0, disconnect_every=0):
+        super().__init__((host, port), MqttStandInHandler)
+        # called from the connection threads with topic, payload, receive time and packet size
+        self.on_message = on_message
+        self.disconnect_every = disconnect_every
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.protocol_errors = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+# Benchmark of dbus-mqtt-battery-sender
+# Starts a private dbus daemon, a synthetic battery (fake_battery.py), a local MQTT stand-in
+# (mqtt_stand_in.py) and the driver with a generated config.ini and measures messages per second,
+# the latency from the change on the dbus to the broker, the CPU time per message and the memory.
+#
+# example: python benchmark/run.py --rate 10 --duration 60 --set MQTT.payload_format=msgpack
+# reconnect with topic alias and QoS 1:
+#          python benchmark/run.py --rate 10 --disconnect-every 50 --set MQTT.protocol_version=5 --set MQTT.qos=1
+
+import argparse
+import configparser
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from time import sleep
+
+from mqtt_stand_in import MqttStandIn
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+DRIVER_DIR = os.path.join(BENCHMARK_DIR, "..", "dbus-mqtt-battery-sender")
+TOPIC = "benchmark/battery"
+
+
+def get_cpu_seconds(pid):
+    # utime + stime of /proc/<pid>/stat, the process name can contain spaces
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def get_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def get_decoder(payload_format):
+    # returns a function which extracts Benchmark.Sent from a payload or None, if the format has no such value
+    if payload_format == "json":
+        return lambda payload: json.loads(payload)["Benchmark"]["Sent"]
+    if payload_format == "msgpack":
+        import msgpack  # pyright: ignore[reportMissingImports]
+
+        return lambda payload: msgpack.unpackb(payload)["Benchmark"]["Sent"]
+    if payload_format == "cbor":
+        import cbor2  # pyright: ignore[reportMissingImports]
+
+        return lambda payload: cbor2.loads(payload)["Benchmark"]["Sent"]
+    return None
+
+
+def write_config(path, battery_path, port, overrides):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "DEFAULT": {
+            "logging": "WARNING",
+            "timeout": "0",
+            "battery_path": battery_path,
+        },
+        "MQTT": {
+            "broker_address": "127.0.0.1",
+            "broker_port": str(port),
+            "topic": TOPIC,
+        },
+    })
+    for override in overrides:
+        key, value = override.split("=", 1)
+        section, key = key.split(".", 1)
+        config[section][key] = value
+    with open(path, "w") as file:
+        config.write(file)
+    return config
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of dbus-mqtt-battery-sender")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before the measurement starts")
+    parser.add_argument("--rate", type=float, default=1.0, help="changes per second of the synthetic battery")
+    parser.add_argument("--cells", type=int, default=16, help="number of cells of the synthetic battery")
+    parser.add_argument("--batched", action="store_true", help="the synthetic battery sends one ItemsChanged per change")
+    parser.add_argument("--disconnect-every", type=int, default=0, help="the broker closes the connection after this many publishes")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.key=value", help="config.ini setting of the driver, can be repeated")
+    args = parser.parse_args()
+
+    processes = []
+    messages = []
+    lock = threading.Lock()
+
+    def on_message(topic, payload, received, size):
+        with lock:
+            messages.append((topic, payload, received, size))
+
+    broker = MqttStandIn(on_message, disconnect_every=args.disconnect_every)
+    broker.start()
+
+    tmp_dir = tempfile.mkdtemp(prefix="dbus-mqtt-battery-sender-benchmark-")
+    try:
+        # private session bus, the driver and vedbus use it instead of the system bus
+        dbus_daemon = subprocess.Popen(["dbus-daemon", "--session", "--print-address=1", "--nofork"], stdout=subprocess.PIPE, text=True)
+        processes.append(dbus_daemon)
+        env = dict(os.environ)
+        env["DBUS_SESSION_BUS_ADDRESS"] = dbus_daemon.stdout.readline().strip()
+        # the portal id is read from the network interface, if /sbin/get-unique-id does not exist
+        env.setdefault("VRM_IFACE", "lo")
+
+        driver_dir = os.path.join(tmp_dir, "dbus-mqtt-battery-sender")
+        shutil.copytree(DRIVER_DIR, driver_dir, ignore=shutil.ignore_patterns("config.ini", "__pycache__"))
+        config = write_config(os.path.join(driver_dir, "config.ini"), "benchmark", broker.port, args.set)
+
+        fake_battery = [sys.executable, os.path.join(BENCHMARK_DIR, "fake_battery.py"), "--name", "benchmark", "--rate", str(args.rate), "--cells", str(args.cells)]
+        if args.batched:
+            fake_battery.append("--batched")
+        processes.append(subprocess.Popen(fake_battery, env=env))
+        sleep(1)
+
+        driver = subprocess.Popen([sys.executable, os.path.join(driver_dir, "dbus-mqtt-battery-sender.py")], env=env)
+        processes.append(driver)
+
+        sleep(args.warmup)
+        with lock:
+            start_index = len(messages)
+        cpu_start = get_cpu_seconds(driver.pid)
+        rss_start = get_rss_kb(driver.pid)
+
+        sleep(args.duration)
+        with lock:
+            window = messages[start_index:]
+        cpu_end = get_cpu_seconds(driver.pid)
+        rss_end = get_rss_kb(driver.pid)
+
+        if driver.poll() is not None:
+            print(f"ERROR: the driver exited with {driver.returncode}")
+            return 1
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            process.wait()
+        broker.shutdown()
+        shutil.rmtree(tmp_dir)
+
+    # end to end latency from the full payload or from the fanout topic
+    payload_format = config["MQTT"].get("payload_format", "json")
+    decode = get_decoder(payload_format)
+    latencies = []
+    for topic, payload, received, _ in window:
+        try:
+            if topic == TOPIC or topic == TOPIC + "/" + payload_format:
+                sent = decode(payload) if decode else None
+            elif topic == TOPIC + "/Benchmark/Sent":
+                sent = float(payload)
+            else:
+                continue
+        except (KeyError, TypeError, ValueError):
+            continue
+        if sent is not None:
+            latencies.append(received - sent)
+
+    count = len(window)
+    size = sum(message[3] for message in window)
+    print(f"rate:       {args.rate:g} changes/s, {args.cells} cells, {'ItemsChanged' if args.batched else 'PropertiesChanged'}")
+    print(f"messages:   {count} in {args.duration:g} s = {count / args.duration:.1f} messages/s, {size / args.duration / 1024:.1f} KiB/s")
+    if latencies:
+        print(
+            f"latency:    median {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p95 {percentile(latencies, 95) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms"
+        )
+    else:
+        print("latency:    not available, no payload with Benchmark.Sent received")
+    cpu = cpu_end - cpu_start
+    print(f"cpu:        {cpu:.2f} s = {cpu / args.duration * 100:.1f} %" + (f", {cpu / count * 1000:.2f} ms/message" if count else ""))
+    print(f"broker:     {broker.connections} connections, {broker.protocol_errors} protocol errors")
+    print(f"memory:     {rss_start} kB -> {rss_end} kB RSS ({rss_end - rss_start:+d} kB)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
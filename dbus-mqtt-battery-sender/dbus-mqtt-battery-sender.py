@@ -1,53 +1,86 @@
 #!/usr/bin/env python
 
+from time import sleep, time, perf_counter, monotonic
+
+# startup timing, reported at INFO level with the first publish
+startup_steps = [("start", perf_counter())]
+
 from gi.repository import GLib  # pyright: ignore[reportMissingImports]
 #import platform
 import logging
+import math
 import sys
 import os
-from time import sleep
-import json
+import random
+import threading
+from collections import deque
+from fnmatch import fnmatchcase
 import paho.mqtt.client as mqtt
 import configparser  # for config/ini file
 import _thread
 import dbus
 
+# use orjson for the payload, if it is installed, it is several times faster than json
+try:
+    import orjson
+
+    def dumps(value):
+        return orjson.dumps(value).decode()
+
+    loads = orjson.loads
+
+except ImportError:
+    import json
+
+    def dumps(value):
+        return json.dumps(value, separators=(",", ":"))
+
+    loads = json.loads
+
+startup_steps.append(("imports", perf_counter()))
+
 # import Victron Energy packages
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext", "velib_python"))
 from vedbus import VeDbusService, VeDbusItemImport  # noqa: E402
-from ve_utils import get_vrm_portal_id  # noqa: E402
-
-skiplist = []
-skiplist.append("CurrentAvg")
-skiplist.append("FirmwareVersion")
-skiplist.append("HardwareVersion")
-skiplist.append("Connected")
-skiplist.append("Serial")
-skiplist.append("CustomName")
-skiplist.append("DeviceName")
-skiplist.append("Temperature1")
-skiplist.append("Temperature2")
-skiplist.append("Temperature3")
-skiplist.append("Temperature4")
-skiplist.append("Temperature1Name")
-skiplist.append("Temperature2Name")
-skiplist.append("Temperature3Name")
-skiplist.append("Temperature4Name")
-skiplist.append("ProcessVersion")
-skiplist.append("ProcessName")
-skiplist.append("Connection")
-skiplist.append("DeviceInstance")
-skiplist.append("ProductId")
-skiplist.append("ProductName")
-skiplist.append("ChargeMode")
-skiplist.append("ChargeModeDebug")
-skiplist.append("BatteryLowVoltage")
-skiplist.append("ChargeLimitation")
-skiplist.append("DischargeLimitation")
-skiplist.append("ForceChargingOff")
-skiplist.append("ForceDischargingOff")
-skiplist.append("TurnBalancingOff")
-skiplist.append("BmsCable")
+from ve_utils import get_vrm_portal_id, unwrap_dbus_value, add_name_owner_changed_receiver  # noqa: E402
+
+# values which are not sent
+skiplist = frozenset([
+    "CurrentAvg",
+    "FirmwareVersion",
+    "HardwareVersion",
+    "Connected",
+    "Serial",
+    "CustomName",
+    "DeviceName",
+    "Temperature1",
+    "Temperature2",
+    "Temperature3",
+    "Temperature4",
+    "Temperature1Name",
+    "Temperature2Name",
+    "Temperature3Name",
+    "Temperature4Name",
+    "ProcessVersion",
+    "ProcessName",
+    "Connection",
+    "DeviceInstance",
+    "ProductId",
+    "ProductName",
+    "ChargeMode",
+    "ChargeModeDebug",
+    "BatteryLowVoltage",
+    "ChargeLimitation",
+    "DischargeLimitation",
+    "ForceChargingOff",
+    "ForceDischargingOff",
+    "TurnBalancingOff",
+    "BmsCable",
+])
+
+# JSON location for each dbus path, built once per path
+# (key,) for a value in the root, (key, subkey) for a value in a sub dict and None if the path is not sent
+payload_paths = {}
 
 # get values from config.ini file
 try:
@@ -99,148 +132,2281 @@ else:
     timeout = 60
 
 
+# get batteries
+# battery_path and topic can be comma separated lists to send several batteries with one driver
+# battery_path = auto sends all batteries found on the dbus
+battery_paths = [battery_path.strip() for battery_path in config["DEFAULT"]["battery_path"].split(",") if battery_path.strip() != ""]
+mqtt_topics = [mqtt_topic.strip() for mqtt_topic in config["MQTT"]["topic"].split(",") if mqtt_topic.strip() != ""]
+if len(battery_paths) == 0 or len(battery_paths) != len(mqtt_topics):
+    print('ERROR:The "config.ini" needs one topic for each battery_path. The driver restarts in 60 seconds.')
+    sleep(60)
+    sys.exit()
+
+# each battery found in auto mode needs its own topic, else they overwrite each other
+if battery_paths == ["auto"] and "{battery_path}" not in mqtt_topics[0]:
+    print('ERROR:The topic needs {battery_path}, when battery_path = auto is used. The driver restarts in 60 seconds.')
+    sleep(60)
+    sys.exit()
+
+# battery paths starting with one of these are not sent in auto mode, e.g. the batteries received by dbus-mqtt-battery
+if "battery_path_exclude" in config["DEFAULT"]:
+    battery_paths_exclude = tuple(battery_path.strip() for battery_path in config["DEFAULT"]["battery_path_exclude"].split(",") if battery_path.strip() != "")
+else:
+    battery_paths_exclude = ("mqtt_battery",)
+
+# dbus paths which are sent, e.g. /Dc/0/*, /Soc, empty = all paths, which are not in the skiplist
+# stored without leading slash like the paths in the mirror of the battery
+if "include_paths" in config["DEFAULT"]:
+    include_paths = tuple(include_path.strip().lstrip("/") for include_path in config["DEFAULT"]["include_paths"].split(",") if include_path.strip() != "")
+else:
+    include_paths = ()
+# paths without wildcards, they get their own signal receiver instead of receiving the signals of all paths
+include_paths_exact = tuple(include_path for include_path in include_paths if not any(char in include_path for char in "*?["))
+
+
+# get engine
+# glib = GLib main loop with dbus-python and the network thread of paho
+# asyncio = one asyncio event loop with dbus-next and aiomqtt
+if "engine" in config["DEFAULT"] and config["DEFAULT"]["engine"] == "asyncio":
+    engine = "asyncio"
+else:
+    engine = "glib"
+
+
+# get update mode
+# event = mirror the battery tree from D-Bus signals and publish only when a value changed
+# poll = read the whole battery tree, the interval adapts between poll_interval_min and poll_interval_max
+if "DEFAULT" in config and "update_mode" in config["DEFAULT"] and config["DEFAULT"]["update_mode"] == "poll":
+    update_mode = "poll"
+else:
+    update_mode = "event"
+
+# in event mode the full JSON is published again, when nothing was published for keepalive_interval seconds,
+# else dbus-mqtt-battery drops an idle battery after its timeout
+if "keepalive_interval" in config["DEFAULT"]:
+    keepalive_interval = int(config["DEFAULT"]["keepalive_interval"])
+else:
+    keepalive_interval = 15
+
+
+# get poll intervals
+# in poll mode the interval drops to poll_interval_min, when Dc/Current or Dc/Power change faster than the
+# activity thresholds and doubles up to poll_interval_max while the battery is idle
+if "poll_interval_min" in config["DEFAULT"]:
+    poll_interval_min = int(config["DEFAULT"]["poll_interval_min"])
+else:
+    poll_interval_min = 3000
+
+if "poll_interval_max" in config["DEFAULT"]:
+    poll_interval_max = int(config["DEFAULT"]["poll_interval_max"])
+else:
+    poll_interval_max = 3000
+
+if "poll_activity_current" in config["DEFAULT"]:
+    poll_activity_current = float(config["DEFAULT"]["poll_activity_current"])
+else:
+    poll_activity_current = 1.0
+
+if "poll_activity_power" in config["DEFAULT"]:
+    poll_activity_power = float(config["DEFAULT"]["poll_activity_power"])
+else:
+    poll_activity_power = 50.0
+
+
+# get delta settings
+# publish only the values, which changed more than their deadband and the full JSON every delta_full_interval seconds
+if "delta_enabled" in config["MQTT"] and config["MQTT"]["delta_enabled"] == "1":
+    delta_enabled = True
+else:
+    delta_enabled = False
+
+if "delta_full_interval" in config["MQTT"]:
+    delta_full_interval = int(config["MQTT"]["delta_full_interval"])
+else:
+    delta_full_interval = 60
+
+# key is the path in the JSON, value is a tuple (deadband, relative)
+delta_deadbands = {}
+# raw=True, since % would be used for interpolation
+if "delta_deadbands" in config["MQTT"] and config.get("MQTT", "delta_deadbands", raw=True) != "":
+    for deadband in config.get("MQTT", "delta_deadbands", raw=True).split(","):
+        deadband_path, deadband_value = deadband.split(":")
+        deadband_value = deadband_value.strip()
+        delta_deadbands[deadband_path.strip().strip("/")] = (float(deadband_value.rstrip("%")), deadband_value.endswith("%"))
+
+
+# get reconnect delays
+# the delay doubles after each failed reconnect up to reconnect_delay_max seconds
+if "reconnect_delay_min" in config["MQTT"]:
+    reconnect_delay_min = int(config["MQTT"]["reconnect_delay_min"])
+else:
+    reconnect_delay_min = 1
+
+if "reconnect_delay_max" in config["MQTT"]:
+    reconnect_delay_max = int(config["MQTT"]["reconnect_delay_max"])
+else:
+    reconnect_delay_max = 120
+
+
+# get offline buffer settings
+# keep up to offline_buffer_size samples while the broker is not reachable and send them after the reconnect
+if "offline_buffer_size" in config["MQTT"]:
+    offline_buffer_size = int(config["MQTT"]["offline_buffer_size"])
+else:
+    offline_buffer_size = 0
+
+if "offline_buffer_max_age" in config["MQTT"]:
+    offline_buffer_max_age = int(config["MQTT"]["offline_buffer_max_age"])
+else:
+    offline_buffer_max_age = 86400
+
+if "offline_buffer_interval" in config["MQTT"]:
+    offline_buffer_interval = int(config["MQTT"]["offline_buffer_interval"])
+else:
+    offline_buffer_interval = 3
+
+if "offline_buffer_path" in config["MQTT"] and config["MQTT"]["offline_buffer_path"] != "":
+    offline_buffer_path = config["MQTT"]["offline_buffer_path"]
+else:
+    offline_buffer_path = None
+
+
+# get payload format
+# json = compatible with dbus-mqtt-battery, all other formats are published to <topic>/<payload_format>
+if "payload_format" in config["MQTT"]:
+    payload_format = config["MQTT"]["payload_format"]
+else:
+    payload_format = "json"
+
+
+# get cell format
+# keys = one key per cell (compatible with dbus-mqtt-battery), array = one list per Voltages and Balances,
+# array_mv = same as array with integer millivolts
+if "cell_format" in config["MQTT"]:
+    cell_format = config["MQTT"]["cell_format"]
+    if cell_format not in ("keys", "array", "array_mv"):
+        logging.error(f'Unknown cell_format "{cell_format}", use keys, array or array_mv. The driver restarts in 60 seconds.')
+        sleep(60)
+        sys.exit()
+else:
+    cell_format = "keys"
+
+
+# get event mode publish limits
+# changes are collected for publish_window milliseconds and published as one message,
+# publish_rate_max limits the messages per second and battery with a token bucket
+if "publish_window" in config["MQTT"]:
+    publish_window = int(config["MQTT"]["publish_window"])
+else:
+    publish_window = 100
+
+if "publish_rate_max" in config["MQTT"]:
+    publish_rate_max = float(config["MQTT"]["publish_rate_max"])
+else:
+    publish_rate_max = 0
+
+
+# get command settings
+# writes to <topic>/set/<path> are applied to the battery, if the path is in command_paths
+# stored without leading slash like the paths in the mirror of the battery
+if "command_paths" in config["MQTT"]:
+    command_paths = frozenset(command_path.strip().lstrip("/") for command_path in config["MQTT"]["command_paths"].split(",") if command_path.strip() != "")
+else:
+    command_paths = frozenset()
+
+# minimum seconds between two writes to the same path
+if "command_interval" in config["MQTT"]:
+    command_interval = float(config["MQTT"]["command_interval"])
+else:
+    command_interval = 1
+
+
+# get fan-out setting
+# publish each value additionally as retained topic <topic>/<key>/<subkey>, e.g. jbd_bat1/Dc/Power
+if "fanout_enabled" in config["MQTT"] and config["MQTT"]["fanout_enabled"] == "1":
+    fanout_enabled = True
+else:
+    fanout_enabled = False
+
+
+# get publish settings
+# qos and retain are used for the JSON, fan-out values and status are always retained
+if "qos" in config["MQTT"]:
+    mqtt_qos = int(config["MQTT"]["qos"])
+else:
+    mqtt_qos = 0
+
+if "retain" in config["MQTT"] and config["MQTT"]["retain"] == "1":
+    mqtt_retain = True
+else:
+    mqtt_retain = False
+
+if "max_inflight_messages" in config["MQTT"]:
+    mqtt_max_inflight_messages = int(config["MQTT"]["max_inflight_messages"])
+else:
+    mqtt_max_inflight_messages = 20
+
+if "max_queued_messages" in config["MQTT"]:
+    mqtt_max_queued_messages = int(config["MQTT"]["max_queued_messages"])
+else:
+    mqtt_max_queued_messages = 1000
+
+
+# get MQTT v5 settings
+# topic aliases, message expiry and user properties are only available with MQTT v5
+if "protocol_version" in config["MQTT"] and config["MQTT"]["protocol_version"] == "5":
+    mqtt_v5 = True
+else:
+    mqtt_v5 = False
+
+if "message_expiry" in config["MQTT"]:
+    mqtt_message_expiry = int(config["MQTT"]["message_expiry"])
+else:
+    mqtt_message_expiry = 0
+
+# only with QoS 0, paho sends unacknowledged QoS 1 and 2 messages again after a reconnect with their empty topic,
+# but the alias is not known on the new connection and the broker disconnects
+if ("topic_alias" in config["MQTT"] and config["MQTT"]["topic_alias"] == "0") or mqtt_qos > 0:
+    mqtt_topic_alias = False
+else:
+    mqtt_topic_alias = True
+
+# version of the JSON structure, sent as user property with MQTT v5
+schema_version = "1"
+
+
+# get metrics settings
+# metrics_port > 0 starts a HTTP server with the metrics in Prometheus format on /metrics
+if "metrics_port" in config["DEFAULT"]:
+    metrics_port = int(config["DEFAULT"]["metrics_port"])
+else:
+    metrics_port = 0
+
+if "metrics_address" in config["DEFAULT"]:
+    metrics_address = config["DEFAULT"]["metrics_address"]
+else:
+    metrics_address = "127.0.0.1"
+
+# metrics_topic publishes the metrics as JSON every metrics_interval seconds
+if "metrics_topic" in config["DEFAULT"]:
+    metrics_topic = config["DEFAULT"]["metrics_topic"]
+else:
+    metrics_topic = ""
+
+if "metrics_interval" in config["DEFAULT"]:
+    metrics_interval = int(config["DEFAULT"]["metrics_interval"])
+else:
+    metrics_interval = 60
+
 
 # set variables
-connected = 0
+# set and cleared in the MQTT thread, read in the GLib main loop
+connected = threading.Event()
+services = []
+# counts the connections to the broker, topic aliases are only valid for one connection
+mqtt_connection_count = 0
+# maximum topic alias the broker accepts on the current connection
+mqtt_topic_alias_maximum = 0
+# payload topic -> topic alias, a battery found again after a restart of its service gets its old alias
+mqtt_topic_aliases = {}
+# VRM portal id, read from portal_id_file
+portal_id = None
+# the portal id of the last run, /sbin/get-unique-id is slow while all services start after a reboot
+portal_id_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "portal_id")
+
+startup_steps.append(("config", perf_counter()))
+
+
+def startup_step(name):
+    # records the time of a startup step, the first publish logs the report
+    if startup_steps is None:
+        return
+    startup_steps.append((name, perf_counter()))
+
+
+def log_startup():
+    global startup_steps
+    if startup_steps is None:
+        return
+    start = startup_steps[0][1]
+    logging.info("Startup timing: " + ", ".join(f"{name} {(step - start) * 1000:.0f} ms" for name, step in startup_steps[1:]))
+    startup_steps = None
+
+
+def get_portal_id():
+    # use the cached portal id and check it in the background, so the MQTT client can connect immediately
+    global portal_id
+    if portal_id is None:
+        try:
+            with open(portal_id_file, "r") as f:
+                portal_id = f.read().strip() or None
+        except OSError:
+            pass
+
+        if portal_id is None:
+            portal_id = update_portal_id()
+        else:
+            threading.Thread(target=update_portal_id, daemon=True).start()
+    return portal_id
+
+
+def update_portal_id():
+    portal_id_current = get_vrm_portal_id()
+    if portal_id_current != portal_id:
+        if portal_id is not None:
+            logging.warning(f"The portal id changed from {portal_id} to {portal_id_current}, it is used after the next restart")
+        try:
+            with open(portal_id_file + ".tmp", "w") as f:
+                f.write(portal_id_current)
+            os.replace(portal_id_file + ".tmp", portal_id_file)
+        except OSError as err:
+            logging.error(f"Could not save portal id {portal_id_file}: {err}")
+    return portal_id_current
+
+
+class PublishTracker:
+    # the MQTT thread only appends to the deque, all counting is done in the GLib main loop, so no lock is needed
+    def __init__(self):
+        self._events = deque()
+        # mid -> time of the publish
+        self._unacked = {}
+        # mid -> time of the acknowledge, for messages acknowledged before add() was called
+        self._acked_early = {}
+
+        self.published = 0
+        self.acknowledged = 0
+        self.dropped = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    # called from the MQTT thread
+    def on_publish(self, mid):
+        self._events.append((mid, time()))
+
+    # called from the MQTT thread
+    def on_disconnect(self):
+        self._events.append((None, time()))
+
+    def add(self, result):
+        published = time()
+        self.process()
+        if result[0] == 0:
+            self.published += 1
+            self._unacked[result[1]] = published
+            if result[1] in self._acked_early:
+                self._acknowledge(result[1], self._acked_early.pop(result[1]))
+        else:
+            self.dropped += 1
+
+    def fail(self, mid):
+        # asyncio engine: the publish raised an error, the message is not sent again
+        self.process()
+        if self._unacked.pop(mid, None) is not None:
+            self.dropped += 1
+
+    def process(self):
+        while self._events:
+            mid, timestamp = self._events.popleft()
+            if mid is None:
+                # QoS 0 messages in flight are lost on a disconnect, the others are sent again by paho
+                if mqtt_qos == 0:
+                    self.dropped += len(self._unacked)
+                    self._unacked.clear()
+                continue
+
+            if mid in self._unacked:
+                self._acknowledge(mid, timestamp)
+            else:
+                self._acked_early[mid] = timestamp
+
+    def _acknowledge(self, mid, timestamp):
+        latency = max(0.0, timestamp - self._unacked.pop(mid))
+        self.acknowledged += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        metrics.observe("publish_latency_seconds", latency)
+        logging.debug("MQTT client: Message %d acknowledged after %.1f ms", mid, latency * 1000)
+
+    @property
+    def in_flight(self):
+        return len(self._unacked)
+
+    def get_unacked_age(self, now):
+        # age of the oldest message, which was not acknowledged yet
+        self.process()
+        if len(self._unacked) == 0:
+            return 0
+        return now - min(self._unacked.values())
+
+    def log_stats(self):
+        self.process()
+
+        # messages without acknowledge after 5 minutes are counted as dropped
+        now = time()
+        for mid, published in list(self._unacked.items()):
+            if now - published > 300:
+                del self._unacked[mid]
+                self.dropped += 1
+        self._acked_early.clear()
+
+        logging.info(
+            f"MQTT client: {self.published} published, {self.acknowledged} acknowledged, {self.dropped} dropped, {len(self._unacked)} in flight, "
+            f"latency avg {self.latency_sum * 1000 / max(1, self.acknowledged):.1f} ms max {self.latency_max * 1000:.1f} ms"
+        )
+        return True
+
+
+publish_tracker = PublishTracker()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # not cumulative, the last entry counts the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # written in the GLib main loop and read by the HTTP server thread, a scrape may see a tick half counted
+    seconds_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+    bytes_buckets = (64, 128, 256, 512, 1024, 2048, 4096, 8192)
+    prefix = "dbus_mqtt_battery_sender_"
+
+    def __init__(self):
+        self.counters = {
+            "ticks_skipped": 0,
+            "dbus_read_errors": 0,
+            "publishes_rate_limited": 0,
+        }
+        self.histograms = {
+            "dbus_read_seconds": Histogram(self.seconds_buckets),
+            "payload_build_seconds": Histogram(self.seconds_buckets),
+            "payload_bytes": Histogram(self.bytes_buckets),
+            "publish_latency_seconds": Histogram(self.seconds_buckets),
+        }
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def get_values(self):
+        values = {
+            "batteries": len(services),
+            "published": publish_tracker.published,
+            "publish_acknowledged": publish_tracker.acknowledged,
+            "publish_failures": publish_tracker.dropped,
+            "publish_queue_depth": publish_tracker.in_flight,
+            "mqtt_reconnects": max(0, mqtt_connection_count - 1),
+            "rss_bytes": get_rss(),
+        }
+        values.update(self.counters)
+        return values
+
+    def as_dict(self):
+        result = self.get_values()
+        for name, histogram in self.histograms.items():
+            result[name] = {"count": histogram.count, "sum": round(histogram.sum, 6)}
+        return result
+
+    def render_prometheus(self):
+        lines = []
+        for name, value in self.get_values().items():
+            lines.append(f"{self.prefix}{name} {value}")
+        for name, histogram in self.histograms.items():
+            lines.append(f"# TYPE {self.prefix}{name} histogram")
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{self.prefix}{name}_bucket{{le="{bucket}"}} {cumulative}')
+            lines.append(f'{self.prefix}{name}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{self.prefix}{name}_sum {histogram.sum}")
+            lines.append(f"{self.prefix}{name}_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def get_rss():
+    # resident set size from /proc, 0 if not available
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_mqtt_settings():
+    # TLS and credentials of config.ini, used by both engines
+    # returns tls_enabled, tls_path_to_ca (None = system CAs), tls_insecure, username and password (None = anonymous)
+    tls_enabled = False
+    tls_path_to_ca = None
+    tls_insecure = False
+    if "tls_enabled" in config["MQTT"] and config["MQTT"]["tls_enabled"] == "1":
+        logging.info("MQTT client: TLS is enabled")
+        tls_enabled = True
+
+        if "tls_path_to_ca" in config["MQTT"] and config["MQTT"]["tls_path_to_ca"] != "":
+            logging.info('MQTT client: TLS: custom ca "%s" used' % config["MQTT"]["tls_path_to_ca"])
+            tls_path_to_ca = config["MQTT"]["tls_path_to_ca"]
+
+        if "tls_insecure" in config["MQTT"] and config["MQTT"]["tls_insecure"] != "":
+            logging.info("MQTT client: TLS certificate server hostname verification disabled")
+            tls_insecure = True
+
+    # check if username and password are set
+    username = None
+    password = None
+    if "username" in config["MQTT"] and "password" in config["MQTT"] and config["MQTT"]["username"] != "" and config["MQTT"]["password"] != "":
+        logging.info('MQTT client: Using username "%s" and password to connect' % config["MQTT"]["username"])
+        username = config["MQTT"]["username"]
+        password = config["MQTT"]["password"]
+
+    return tls_enabled, tls_path_to_ca, tls_insecure, username, password
 
 
 # MQTT requests
-def on_disconnect(client, userdata, rc):
-    global connected
+def on_disconnect(client, userdata, rc, properties=None):
+    connected.clear()
+    publish_tracker.on_disconnect()
     logging.warning("MQTT client: Got disconnected")
     if rc != 0:
+        # the reconnect is done by the network loop of paho with the delays set by reconnect_delay_set()
         logging.warning("MQTT client: Unexpected MQTT disconnection. Will auto-reconnect")
     else:
         logging.warning("MQTT client: rc value:" + str(rc))
 
-    while connected == 0:
-        try:
-            logging.warning(f"MQTT client: Trying to reconnect to broker {config['MQTT']['broker_address']} on port {config['MQTT']['broker_port']}")
-            client.connect(host=config["MQTT"]["broker_address"], port=int(config["MQTT"]["broker_port"]))
-            connected = 1
-        except Exception as err:
-            logging.error(f"MQTT client: Error in retrying to connect with broker ({config['MQTT']['broker_address']}:{config['MQTT']['broker_port']}): {err}")
-            logging.error("MQTT client: Retrying in 15 seconds")
-            connected = 0
-            sleep(15)
-
 
-def on_connect(client, userdata, flags, rc):
-    global connected
+def on_connect(client, userdata, flags, rc, properties=None):
+    global mqtt_connection_count, mqtt_topic_alias_maximum
     if rc == 0:
         logging.info("MQTT client: Connected to MQTT broker!")
-        connected = 1
-        client.subscribe(config["MQTT"]["topic"])
+        if mqtt_connection_count == 0:
+            startup_step("connected")
+        mqtt_connection_count += 1
+        # MQTT v5 only, the broker sends its maximum in the CONNACK properties
+        mqtt_topic_alias_maximum = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
+        if mqtt_topic_alias and len(mqtt_topic_aliases) > mqtt_topic_alias_maximum:
+            logging.info(f"MQTT client: The broker accepts {mqtt_topic_alias_maximum} topic aliases, the other batteries are sent without")
+        connected.set()
+        # MQTT thread, a copy of the list, because the battery discovery adds and removes services in the GLib main loop
+        for service in list(services):
+            service.subscribe_commands()
+            # the broker may have lost the retained state, so start with the full JSON
+            service.request_full_snapshot()
+    else:
+        logging.error("MQTT client: Failed to connect, return code %s\n", rc)
+
+
+def on_publish(client, userdata, mid):
+    publish_tracker.on_publish(mid)
+
+
+def publish_metrics(client):
+    if connected.is_set():
+        client.publish(metrics_topic, dumps(metrics.as_dict()))
+    return True
+
+
+def start_metrics_server():
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # do not log every scrape
+            pass
+
+    server = ThreadingHTTPServer((metrics_address, metrics_port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Metrics are available on http://{metrics_address}:{metrics_port}/metrics")
+
+
+# exits the driver, if the battery or the MQTT client did not respond for timeout seconds,
+# so daemontools restarts it instead of leaving the last values on the broker
+def watchdog():
+    now = time()
+    stale_services = [service for service in services if service.is_stale(now)]
+
+    # while disconnected the reconnect is handled by paho
+    if connected.is_set() and publish_tracker.get_unacked_age(now) > timeout:
+        logging.error(f"MQTT client: No publish was acknowledged for {timeout} seconds")
+        stale_services = services
+    elif stale_services:
+        logging.error(f"No dbus update for {timeout} seconds from: {', '.join(service.name for service in stale_services)}")
+
+    if stale_services:
+        for service in stale_services:
+            service.publish_stale()
+        # give the MQTT client one second to send the stale markers
+        logging.error("The driver restarts in 1 second.")
+        GLib.timeout_add(1000, os._exit, 1)
+        return False
+
+    return True
+
+
+def get_payload_path(dbus_path):
+    try:
+        return payload_paths[dbus_path]
+    except KeyError:
+        pass
+
+    path = dbus_path.replace("/0/", "/").split("/")
+    if include_paths and not any(fnmatchcase(dbus_path, include_path) for include_path in include_paths):
+        payload_path = None
+    elif len(path) == 1 and path[0] not in skiplist:
+        payload_path = (path[0],)
+    elif len(path) == 2 and path[1] not in skiplist:
+        payload_path = (path[0], path[1])
+    else:
+        payload_path = None
+
+    payload_paths[dbus_path] = payload_path
+    return payload_path
+
+
+# list index for each cell key, built once per key
+# e.g. Cell1 -> 0 and None for all other keys like Sum or Diff
+cell_indexes = {}
+
+
+def get_cell_index(key):
+    try:
+        return cell_indexes[key]
+    except KeyError:
+        pass
+
+    if key.startswith("Cell") and key[4:].isdigit() and int(key[4:]) > 0:
+        cell_index = int(key[4:]) - 1
     else:
-        logging.error("MQTT client: Failed to connect, return code %d\n", rc)
+        cell_index = None
+
+    cell_indexes[key] = cell_index
+    return cell_index
+
+
+def pack_cells(values, millivolts=False, aggregates=False):
+    # {"Cell1": 3.301, "Cell2": 3.305, "Sum": 6.606} -> {"Cells": [3.301, 3.305], "Sum": 6.606}
+    # missing cells are None, so the list index stays the cell number - 1
+    cells = []
+    packed = {}
+    for key, value in values.items():
+        cell_index = get_cell_index(key)
+        if cell_index is None:
+            packed[key] = value
+            continue
+        if cell_index >= len(cells):
+            cells.extend([None] * (cell_index + 1 - len(cells)))
+        if millivolts and isinstance(value, (int, float)):
+            value = round(value * 1000)
+        cells[cell_index] = value
+    packed["Cells"] = cells
+
+    if aggregates:
+        numbers = [cell for cell in cells if isinstance(cell, (int, float))]
+        if numbers:
+            cell_min = min(numbers)
+            cell_max = max(numbers)
+            cell_avg = sum(numbers) / len(numbers)
+            if millivolts:
+                packed["Min"], packed["Max"], packed["Delta"], packed["Avg"] = cell_min, cell_max, cell_max - cell_min, round(cell_avg)
+            else:
+                packed["Min"], packed["Max"], packed["Delta"], packed["Avg"] = cell_min, cell_max, round(cell_max - cell_min, 4), round(cell_avg, 4)
+
+    return packed
+
+
+def build_payload(dbus_items):
+    started = perf_counter()
+    # reformat dbus to mqtt
+    battery_dict_mqtt = {}
+    for dbus_path, dbus_value in dbus_items.items():
+        if dbus_value is None:
+            continue
+        payload_path = get_payload_path(dbus_path)
+        if payload_path is None:
+            continue
+        if len(payload_path) == 1:
+            battery_dict_mqtt[payload_path[0]] = dbus_value
+        else:
+            battery_dict_mqtt.setdefault(payload_path[0], {})[payload_path[1]] = dbus_value
+    if cell_format != "keys":
+        if "Voltages" in battery_dict_mqtt:
+            battery_dict_mqtt["Voltages"] = pack_cells(battery_dict_mqtt["Voltages"], cell_format == "array_mv", True)
+        if "Balances" in battery_dict_mqtt:
+            battery_dict_mqtt["Balances"] = pack_cells(battery_dict_mqtt["Balances"])
+    metrics.observe("payload_build_seconds", perf_counter() - started)
+    return battery_dict_mqtt
+
+
+def is_complete(battery_dict_mqtt, mqtt_topic):
+    if "Dc" not in battery_dict_mqtt or "Soc" not in battery_dict_mqtt:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("NOT Sending `%s...` to topic `%s`, missing dc or Soc", dumps(battery_dict_mqtt)[0:50], mqtt_topic)
+            logging.debug(battery_dict_mqtt)
+        return False
+
+    if "Power" not in battery_dict_mqtt["Dc"] or "Voltage" not in battery_dict_mqtt["Dc"]:
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("NOT Sending `%s...` to topic `%s`, missing power or voltage", dumps(battery_dict_mqtt)[0:50], mqtt_topic)
+        return False
+
+    return True
+
+
+class JsonSerializer:
+    name = "json"
+    content_type = "application/json"
+
+    def serialize(self, payload):
+        return dumps(payload)
+
+
+class MsgpackSerializer:
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def __init__(self):
+        import msgpack
+
+        self._packb = msgpack.packb
+
+    def serialize(self, payload):
+        return self._packb(payload, use_bin_type=True)
+
+
+class CborSerializer:
+    name = "cbor"
+    content_type = "application/cbor"
+
+    def __init__(self):
+        import cbor2
+
+        self._dumps = cbor2.dumps
+
+    def serialize(self, payload):
+        return self._dumps(payload)
+
+
+class BinaryFrameSerializer:
+    # fixed layout, little endian: version (uint8) followed by one float32 for each field
+    # fields which are not in the payload (e.g. unchanged in delta mode) are NaN
+    name = "bin"
+    content_type = "application/octet-stream"
+    version = 1
+    fields = (
+        ("Dc", "Power"),
+        ("Dc", "Voltage"),
+        ("Dc", "Current"),
+        ("Soc",),
+        ("Info", "MaxChargeVoltage"),
+        ("Info", "MaxChargeCurrent"),
+        ("Info", "MaxDischargeCurrent"),
+    )
+
+    def __init__(self):
+        import struct
+
+        self._struct = struct.Struct("<B" + "f" * len(self.fields))
+
+    def serialize(self, payload):
+        values = []
+        for field in self.fields:
+            value = payload.get(field[0])
+            if len(field) == 2:
+                value = value.get(field[1]) if isinstance(value, dict) else None
+            values.append(float(value) if isinstance(value, (int, float)) else float("nan"))
+        return self._struct.pack(self.version, *values)
+
+
+serializers = {serializer.name: serializer for serializer in (JsonSerializer, MsgpackSerializer, CborSerializer, BinaryFrameSerializer)}
+
+
+class OfflineBuffer:
+    def __init__(
+        self,
+        size,
+        max_age,
+        interval,
+        file=None
+    ):
+
+        self._size = size
+        self._max_age = max_age
+        self._interval = interval
+        self._file = file
+        self._last_saved = 0
+
+        # list of (timestamp, sample), oldest first
+        self._samples = []
+
+        self._load()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, sample):
+        now = time()
+        if len(self._samples) > 0 and now - self._samples[-1][0] < self._interval:
+            return
+
+        self._samples.append((now, sample))
+
+        if len(self._samples) > self._size:
+            # downsample the older half, so long outages keep their whole timespan with a lower resolution
+            half = len(self._samples) // 2
+            self._samples = self._samples[0:half:2] + self._samples[half:]
+            if len(self._samples) > self._size:
+                del self._samples[0]
+
+        # do not write the flash on every sample
+        if self._file is not None and now - self._last_saved >= 60:
+            self._save()
+
+    def get(self):
+        # returns the samples which are not too old, oldest first
+        now = time()
+        return [(timestamp, sample) for timestamp, sample in self._samples if now - timestamp <= self._max_age]
+
+    def remove(self, count):
+        # removes the oldest count samples, after they were sent
+        del self._samples[0:count]
+        if self._file is not None:
+            self._save()
+
+    def clear(self):
+        self._samples.clear()
+        if self._file is not None:
+            self._save()
+
+    def _load(self):
+        if self._file is None or not os.path.exists(self._file):
+            return
+
+        import json
+
+        try:
+            with open(self._file, "r") as f:
+                for line in f:
+                    timestamp, sample = json.loads(line)
+                    self._samples.append((timestamp, sample))
+            logging.info(f"Loaded {len(self._samples)} samples from {self._file}")
+        except Exception as err:
+            logging.error(f"Could not load offline buffer {self._file}: {err}")
+            self._samples.clear()
+
+    def _save(self):
+        self._last_saved = time()
+        try:
+            if len(self._samples) == 0:
+                if os.path.exists(self._file):
+                    os.remove(self._file)
+                return
+
+            os.makedirs(os.path.dirname(self._file), exist_ok=True)
+            with open(self._file + ".tmp", "w") as f:
+                for timestamp, sample in self._samples:
+                    f.write(dumps([round(timestamp, 1), sample]) + "\n")
+            os.replace(self._file + ".tmp", self._file)
+        except Exception as err:
+            logging.error(f"Could not save offline buffer {self._file}: {err}")
 
 
+class TokenBucket:
+    # allows rate messages per second on average and bursts of up to burst messages
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = monotonic()
+
+    def get_wait(self):
+        # seconds until the next message may be sent, 0 if it can be sent now
+        now = monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def take(self):
+        self._tokens -= 1
+
 
 class DbusMqttBatterySenderService:
     def __init__(
         self,
         battery_path,
         mqtt_topic,
-        mqtt_client
+        mqtt_client,
+        dbus_conn,
+        serializer=None
     ):
 
         self._battery_path = battery_path
         self._mqtt_topic = mqtt_topic
         self._mqtt_client = mqtt_client
-        GLib.timeout_add(3000, self._update)  # pause 1000ms before the next request
+        self._dbus_conn = dbus_conn
+        self._serializer = serializer or JsonSerializer()
+
+        # JSON is sent to the topic itself for dbus-mqtt-battery, other formats get their name as suffix
+        if self._serializer.name == "json":
+            self._mqtt_topic_payload = self._mqtt_topic
+        else:
+            self._mqtt_topic_payload = self._mqtt_topic + "/" + self._serializer.name
+        # buffered samples are replayed to their own topic, dbus-mqtt-battery would apply them as current values
+        self._mqtt_topic_history = self._mqtt_topic + "/history" + ("" if self._serializer.name == "json" else "/" + self._serializer.name)
+        self._dbus_service = "com.victronenergy.battery." + self._battery_path
+        self._dbus_matches = []
+        self._stopped = False
+
+        # MQTT v5 properties of the published payload
+        self._topic_alias = None
+        self._topic_alias_connection = None
+        self._properties = None
+        self._properties_alias = None
+        self._properties_replay = None
+        if mqtt_v5:
+            self._init_properties()
+
+        # time of the last successful read or signal from the battery, None while the battery is not on the dbus
+        self._last_dbus_update = None
+        self._status = None
+
+        # proxy of the root, created once and only recreated when the battery service changes its owner
+        self._dbus_proxy = None
+        # GetItems reads all paths in one call, services without it are read with GetValue on the root
+        self._dbus_get_items = True
+
+        # local mirror of the battery tree, the key is the path without leading slash
+        self._dbus_items = {}
+        self._dbus_items_loaded = False
+        self._load_retry_active = False
+        self._publish_scheduled = False
+        self._last_payload = None
+        # time of the last publish to the payload topic, used by the keepalive
+        self._last_publish = monotonic()
+        # limits the publishes in event mode, the changes are merged while waiting
+        if publish_rate_max > 0:
+            self._publish_rate_limit = TokenBucket(publish_rate_max, max(1, publish_rate_max))
+        else:
+            self._publish_rate_limit = None
+
+        # last published value of each JSON path, used to decide which values changed in delta mode
+        self._published = {}
+        self._fanout_published = {}
+        self._full_pending = True
+        # the mirror is read again once before the next full JSON, set by request_full_snapshot
+        self._resync_pending = False
+
+        # samples collected while the broker is not reachable
+        if offline_buffer_size > 0:
+            self._offline_buffer = OfflineBuffer(
+                size=offline_buffer_size,
+                max_age=offline_buffer_max_age,
+                interval=offline_buffer_interval,
+                file=os.path.join(offline_buffer_path, self._battery_path + ".jsonl") if offline_buffer_path is not None else None
+            )
+        else:
+            self._offline_buffer = None
+
+        if delta_enabled and delta_full_interval > 0:
+            GLib.timeout_add_seconds(delta_full_interval, self._full_snapshot_timer)
+        if update_mode == "event" and keepalive_interval > 0:
+            GLib.timeout_add_seconds(keepalive_interval, self._keepalive_timer)
+
+        # the root importer is bound to the unique name of the current owner, so follow restarts of the battery service
+        self._dbus_matches.append(add_name_owner_changed_receiver(self._dbus_conn, self._on_name_owner_changed))
+
+        # commands received in the MQTT thread, applied in the GLib main loop
+        self._commands = deque()
+        self._commands_scheduled = False
+        # importer and time of the last write for each command path
+        self._command_imports = {}
+        self._command_last = {}
+        if command_paths:
+            self._mqtt_client.message_callback_add(self._mqtt_topic + "/set/#", self._on_command)
+            if connected.is_set():
+                self.subscribe_commands()
+
+        if update_mode == "event":
+            # single value changes are signaled by the path itself with PropertiesChanged,
+            # batched changes are signaled by the root with ItemsChanged (same as VeDbusRootTracker)
+            # if only single paths are included, only their signals are received
+            if include_paths and include_paths == include_paths_exact:
+                properties_changed_paths = ["/" + include_path for include_path in include_paths]
+            else:
+                properties_changed_paths = [None]
+            for properties_changed_path in properties_changed_paths:
+                self._dbus_matches.append(
+                    self._dbus_conn.add_signal_receiver(
+                        self._on_properties_changed,
+                        signal_name="PropertiesChanged",
+                        dbus_interface="com.victronenergy.BusItem",
+                        bus_name=self._dbus_service,
+                        path=properties_changed_path,
+                        path_keyword="path"
+                    )
+                )
+            self._dbus_matches.append(
+                self._dbus_conn.add_signal_receiver(
+                    self._on_items_changed,
+                    signal_name="ItemsChanged",
+                    dbus_interface="com.victronenergy.BusItem",
+                    bus_name=self._dbus_service,
+                    path="/"
+                )
+            )
+            # load the whole tree once, retry every 3 seconds until the battery is found
+            self._load_or_retry()
+        else:
+            self._poll_interval = poll_interval_min
+            self._poll_last = None
+            GLib.timeout_add(self._poll_interval, self._update)
+
+    def stop(self):
+        # remove all signal receivers, the timers and idle callbacks stop on their next call
+        self._stopped = True
+        for match in self._dbus_matches:
+            match.remove()
+        self._dbus_matches.clear()
+        self._dbus_proxy = None
+        self._dbus_items.clear()
+        self._command_imports.clear()
+        if command_paths:
+            self._mqtt_client.message_callback_remove(self._mqtt_topic + "/set/#")
+            self._mqtt_client.unsubscribe(self._mqtt_topic + "/set/#")
+        logging.info(f"Stopped sending {self._dbus_service}")
+
+    def _read_dbus(self):
+        started = perf_counter()
+        try:
+            if self._dbus_proxy is None:
+                # bound to the unique name of the current owner, like VeDbusItemImport, but without its GetValue on creation
+                self._dbus_proxy = self._dbus_conn.get_object(self._dbus_service, "/", introspect=False)
+            dbus_items = self._get_items()
+        except dbus.exceptions.DBusException:
+            self._dbus_proxy = None
+            dbus_items = None
+        metrics.observe("dbus_read_seconds", perf_counter() - started)
+
+        if not isinstance(dbus_items, dict):
+            metrics.inc("dbus_read_errors")
+            logging.info("battery not (yet) found")
+            return None
+
+        self._last_dbus_update = time()
+        return dbus_items
+
+    def _get_items(self):
+        if self._dbus_get_items:
+            try:
+                return self._unwrap_items(self._dbus_proxy.GetItems(dbus_interface="com.victronenergy.BusItem"))
+            except dbus.exceptions.DBusException as err:
+                # if GetValue fails as well, the battery is gone and GetItems is tried again with the next owner
+                dbus_items = unwrap_dbus_value(self._dbus_proxy.GetValue(dbus_interface="com.victronenergy.BusItem"))
+                logging.info(f"{self._dbus_service} has no GetItems, using GetValue: {err.get_dbus_name()}")
+                self._dbus_get_items = False
+                return dbus_items
+
+        return unwrap_dbus_value(self._dbus_proxy.GetValue(dbus_interface="com.victronenergy.BusItem"))
+
+    def _unwrap_items(self, items):
+        # GetItems returns {"/path": {"Value": ..., "Text": ...}}, GetValue returns {"path": ...}
+        # only the paths which are sent are unwrapped
+        dbus_items = {}
+        for dbus_path, item in items.items():
+            dbus_path = str(dbus_path).lstrip("/")
+            if "Value" in item and get_payload_path(dbus_path) is not None:
+                dbus_items[dbus_path] = unwrap_dbus_value(item["Value"])
+        return dbus_items
+
+    def _load(self):
+        self._resync_pending = False
+        dbus_items = self._read_dbus()
+        if dbus_items is None:
+            return False
+
+        for dbus_path, dbus_value in dbus_items.items():
+            self._set_item(dbus_path, dbus_value)
+        self._dbus_items_loaded = True
+        logging.info(f"Loaded {len(dbus_items)} paths from {self._dbus_service}")
+        return True
+
+    def _load_or_retry(self):
+        if not self._load() and not self._load_retry_active:
+            self._load_retry_active = True
+            GLib.timeout_add(3000, self._load_retry)
+
+    def _load_retry(self):
+        if self._stopped or self._dbus_items_loaded or self._load():
+            self._load_retry_active = False
+        # returning False stops the timer
+        return self._load_retry_active
+
+    def _on_name_owner_changed(self, name, old_owner, new_owner):
+        if name != self._dbus_service or self._stopped:
+            return
+
+        logging.info(f"{self._dbus_service} changed owner from `{old_owner}` to `{new_owner}`")
+        self._dbus_proxy = None
+        self._command_imports.clear()
+        # the new owner may be another program
+        self._dbus_get_items = True
+        self._last_dbus_update = None
+
+        if update_mode == "event":
+            # values of the old owner are not valid anymore
+            self._dbus_items.clear()
+            self._dbus_items_loaded = False
+            if new_owner != "":
+                self._load_or_retry()
+
+    def _on_properties_changed(self, changes, path=None):
+        self._last_dbus_update = time()
+        path = str(path).lstrip("/")
+        if "Value" in changes and get_payload_path(path) is not None:
+            self._set_item(path, unwrap_dbus_value(changes["Value"]))
+
+    def _on_items_changed(self, items):
+        self._last_dbus_update = time()
+        for dbus_path, changes in items.items():
+            dbus_path = str(dbus_path).lstrip("/")
+            if "Value" in changes and get_payload_path(dbus_path) is not None:
+                self._set_item(dbus_path, unwrap_dbus_value(changes["Value"]))
+
+    def _set_item(self, dbus_path, dbus_value):
+        dbus_path = str(dbus_path).lstrip("/")
+        # keep only the paths which are sent, so the payload is built from them only
+        if dbus_path == "" or get_payload_path(dbus_path) is None:
+            return
+        if dbus_path in self._dbus_items and self._dbus_items[dbus_path] == dbus_value:
+            return
+
+        self._dbus_items[dbus_path] = dbus_value
+        self._schedule_publish()
+
+    def _schedule_publish(self):
+        # collect all changes of the publish window or of this main loop iteration into one publish
+        if not self._publish_scheduled:
+            self._publish_scheduled = True
+            if publish_window > 0:
+                GLib.timeout_add(publish_window, self._publish_items)
+            else:
+                GLib.idle_add(self._publish_items)
+
+    def _publish_items(self):
+        if self._stopped:
+            self._publish_scheduled = False
+            return False
+
+        if self._publish_rate_limit is not None:
+            wait = self._publish_rate_limit.get_wait()
+            if wait > 0:
+                # still scheduled, so all changes until the next token are merged into this publish
+                metrics.inc("publishes_rate_limited")
+                GLib.timeout_add(int(wait * 1000) + 1, self._publish_items)
+                return False
+
+        # the full JSON is sent after a reconnect and every delta_full_interval, resync the mirror with one bulk read before,
+        # only once per request and not while offline, _full_pending stays set until the full JSON was sent.
+        # Still scheduled, so the changes found by the resync do not schedule another publish
+        if self._resync_pending and self._dbus_items_loaded and connected.is_set():
+            self._load()
+        self._publish_scheduled = False
+
+        # only publish, if a forwarded value really changed
+        if self._publish(build_payload(self._dbus_items), only_changes=True) and self._publish_rate_limit is not None:
+            self._publish_rate_limit.take()
+
+        # returning False removes the idle callback
+        return False
 
     def _update(self):
-        global battery_dict
-        global connected
-        global skiplist
+        if self._stopped:
+            return False
+
         # Load values from dbus
-        dbus_conn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
-        dev = "com.victronenergy.battery." + self._battery_path
-        try:
-          dbus_items = VeDbusItemImport(dbus_conn, dev, "/").get_value()
-        except:
-          dbus_items = {}
-          logging.info("battery not (yet) found")
+        dbus_items = self._read_dbus() or {}
+        battery_dict_mqtt = build_payload(dbus_items)
+        self._publish(battery_dict_mqtt)
+
+        # restart the timer, if the interval changed
+        poll_interval = self._get_poll_interval(battery_dict_mqtt)
+        if poll_interval != self._poll_interval:
+            logging.debug("Poll interval of %s changed from %d ms to %d ms", self._dbus_service, self._poll_interval, poll_interval)
+            self._poll_interval = poll_interval
+            GLib.timeout_add(self._poll_interval, self._update)
+            return False
 
-        # reformat dbus to mqtt
-        battery_dict_mqtt = {}
+        return True
+
+    def _get_poll_interval(self, battery_dict_mqtt):
+        if poll_interval_min >= poll_interval_max:
+            return poll_interval_min
+
+        now = time()
+        dc = battery_dict_mqtt.get("Dc", {})
+        active = False
+        if self._poll_last is not None and now > self._poll_last[0]:
+            last_time, last_dc = self._poll_last
+            for key, threshold in (("Current", poll_activity_current), ("Power", poll_activity_power)):
+                if isinstance(dc.get(key), (int, float)) and isinstance(last_dc.get(key), (int, float)):
+                    # change per second
+                    if abs(dc[key] - last_dc[key]) / (now - last_time) > threshold:
+                        active = True
+        self._poll_last = (now, dc)
+
+        if active:
+            return poll_interval_min
+
+        # back off slowly while the battery is idle
+        return min(self._poll_interval * 2, poll_interval_max)
+
+    @property
+    def name(self):
+        return self._dbus_service
+
+    def is_stale(self, now):
+        if self._stopped or self._last_dbus_update is None:
+            return False
+
+        age = now - self._last_dbus_update
+        if update_mode == "event" and age > timeout / 2 and self._dbus_proxy is not None:
+            # no signal for a while, check without blocking the main loop, if the battery still answers
+            if self._dbus_get_items:
+                self._dbus_proxy.GetItems(
+                    dbus_interface="com.victronenergy.BusItem",
+                    reply_handler=lambda items: self._on_probe_reply(self._unwrap_items(items)),
+                    error_handler=self._on_probe_error,
+                    timeout=5
+                )
+            else:
+                self._dbus_proxy.GetValue(
+                    dbus_interface="com.victronenergy.BusItem",
+                    reply_handler=lambda dbus_items: self._on_probe_reply(unwrap_dbus_value(dbus_items)),
+                    error_handler=self._on_probe_error,
+                    timeout=5
+                )
+
+        return age > timeout
+
+    def _on_probe_reply(self, dbus_items):
+        self._last_dbus_update = time()
         for dbus_path, dbus_value in dbus_items.items():
-           dbus_path = dbus_path.replace("/0/","/")
-           path = dbus_path.split('/')
-           if(len(path)==1):
-              if(path[0] in skiplist or dbus_value is None):
-                 continue
-              battery_dict_mqtt.update({path[0]:dbus_value})
-           elif(len(path)==2):
-              if(path[1] in skiplist or dbus_value is None):
-                 continue
-              battery_subdict_mqtt = {}
-              if path[0] in battery_dict_mqtt:
-                 battery_subdict_mqtt = battery_dict_mqtt[path[0]]
-              battery_subdict_mqtt.update({path[1]:dbus_value})
-              battery_dict_mqtt.update({path[0]:battery_subdict_mqtt})
+            self._set_item(dbus_path, dbus_value)
+
+    def _on_probe_error(self, err):
+        logging.warning(f"{self._dbus_service} did not answer: {err}")
+
+    def _create_properties(self, message_expiry=0, topic_alias=None):
+        # only needed for MQTT v5
+        from paho.mqtt.properties import Properties
+        from paho.mqtt.packettypes import PacketTypes
+
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = self._serializer.content_type
+        properties.UserProperty = [("portal_id", get_portal_id()), ("battery_path", self._battery_path), ("schema_version", schema_version)]
+        if message_expiry > 0:
+            # the broker drops the message instead of delivering old values after a reconnect
+            properties.MessageExpiryInterval = message_expiry
+        if topic_alias is not None:
+            properties.TopicAlias = topic_alias
+        return properties
+
+    def _init_properties(self):
+        if mqtt_topic_alias:
+            # one alias per payload topic, so a battery, which is removed and found again, does not use up the aliases
+            self._topic_alias = mqtt_topic_aliases.setdefault(self._mqtt_topic_payload, len(mqtt_topic_aliases) + 1)
+            self._properties_alias = self._create_properties(mqtt_message_expiry, self._topic_alias)
+        self._properties = self._create_properties(mqtt_message_expiry)
+        # replayed samples are old anyway, so they get no expiry
+        self._properties_replay = self._create_properties()
+
+    def _publish_payload(self, payload_data, retain):
+        # the broker accepts only aliases up to its maximum
+        if self._topic_alias is None or self._topic_alias > mqtt_topic_alias_maximum:
+            return self._publish_message(self._mqtt_topic_payload, payload_data, retain=retain, properties=self._properties)
+
+        # the first publish of a connection binds the alias to the topic, afterwards the topic is left empty
+        if self._topic_alias_connection == mqtt_connection_count:
+            topic = ""
+        else:
+            topic = self._mqtt_topic_payload
+        result = self._publish_message(topic, payload_data, retain=retain, properties=self._properties_alias)
+        if result[0] == 0:
+            self._topic_alias_connection = mqtt_connection_count
+        return result
+
+    def _publish_message(self, topic, payload, retain=True, properties=None):
+        result = self._mqtt_client.publish(topic, payload, qos=mqtt_qos, retain=retain, properties=properties)
+        publish_tracker.add(result)
+        return result
+
+    def publish_stale(self):
+        # tell downstream consumers to not trust the last values anymore
+        self._publish_message(self._mqtt_topic + "/Status", "stale")
+        self._status = "stale"
+        # an empty payload removes the retained message, most receivers read only the payload topic and not the status
+        if mqtt_retain:
+            self._publish_message(self._mqtt_topic_payload, None, properties=self._properties)
+        for path in self._fanout_published:
+            self._publish_message(self._mqtt_topic + "/" + path, None)
+
+    def subscribe_commands(self):
+        # called after each connect, the broker forgets the subscriptions of a clean session
+        if command_paths:
+            self._mqtt_client.subscribe(self._mqtt_topic + "/set/#", qos=1)
+
+    def _on_command(self, client, userdata, message):
+        # a retained command would be applied again after every reconnect
+        if message.retain:
+            logging.warning(f"Retained command on {message.topic} ignored")
+            return
+
+        # MQTT thread, only queue the command, GLib.idle_add is thread safe
+        self._commands.append((message.topic[len(self._mqtt_topic + "/set/"):], message.payload))
+        if not self._commands_scheduled:
+            self._commands_scheduled = True
+            GLib.idle_add(self._apply_commands)
+
+    def _apply_commands(self):
+        self._commands_scheduled = False
+        if self._stopped:
+            return False
+
+        # all commands received since the last run are applied together, the last value of a path wins
+        commands = {}
+        while self._commands:
+            path, payload = self._commands.popleft()
+            commands[path] = payload
+        for path, payload in commands.items():
+            self._apply_command(path, payload)
+
+        # returning False removes the idle callback
+        return False
+
+    def _apply_command(self, path, payload):
+        if path not in command_paths:
+            logging.warning(f"Command for {self._dbus_service} rejected, /{path} is not in command_paths")
+            self._publish_command_ack(path, None, "rejected", "not in command_paths")
+            return
+
+        try:
+            value = loads(payload)
+        except ValueError:
+            value = None
+        # json.loads accepts NaN and Infinity, orjson does not, so both decoders reject them
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or (isinstance(value, float) and not math.isfinite(value)):
+            logging.warning(f"Command for {self._dbus_service} /{path} rejected, {payload[0:50]} is not a number")
+            self._publish_command_ack(path, None, "rejected", "not a number")
+            return
+
+        now = time()
+        if now - self._command_last.get(path, 0) < command_interval:
+            self._publish_command_ack(path, value, "rate_limited", f"less than {command_interval} seconds since the last write")
+            return
+        self._command_last[path] = now
+
+        try:
+            if path not in self._command_imports:
+                # createsignal=False, the value is already followed by the signal receivers of the service
+                self._command_imports[path] = VeDbusItemImport(self._dbus_conn, self._dbus_service, "/" + path, createsignal=False)
+            result = self._command_imports[path].set_value(value)
+        except dbus.exceptions.DBusException as err:
+            self._command_imports.pop(path, None)
+            logging.error(f"Command for {self._dbus_service} /{path} failed: {err}")
+            self._publish_command_ack(path, value, "error", str(err))
+            return
+
+        if result == 0:
+            logging.info(f"Command for {self._dbus_service} /{path} applied: {value}")
+            self._publish_command_ack(path, value, "ok")
+        else:
+            # the battery service rejected the value
+            logging.warning(f"Command for {self._dbus_service} /{path} with {value} not accepted by the battery: {result}")
+            self._publish_command_ack(path, value, "error", f"SetValue returned {result}")
+
+    def _publish_command_ack(self, path, value, result, message=None):
+        # not below /set/, else the acknowledge would be received as command
+        ack = {"Value": value, "Result": result}
+        if message is not None:
+            ack["Message"] = message
+        self._publish_message(self._mqtt_topic + "/ack/" + path, dumps(ack), retain=False)
+
+    def request_full_snapshot(self):
+        # can be called from the MQTT thread, GLib.idle_add is thread safe
+        self._full_pending = True
+        self._resync_pending = True
+        if update_mode == "event":
+            self._schedule_publish()
+
+    def _full_snapshot_timer(self):
+        if self._stopped:
+            return False
+
+        self.request_full_snapshot()
+        return True
+
+    def _keepalive_timer(self):
+        if self._stopped:
+            return False
+
+        idle = monotonic() - self._last_publish
+        if idle >= keepalive_interval:
+            # a scheduled publish is sent anyway
+            if not self._publish_scheduled:
+                self._publish_keepalive()
+            idle = 0
+        # check again, when the keepalive_interval after the last publish is over
+        GLib.timeout_add_seconds(max(1, math.ceil(keepalive_interval - idle)), self._keepalive_timer)
+        return False
+
+    def _publish_keepalive(self):
+        # only the full JSON on the payload topic, the fanout topics are retained and keep their values,
+        # the periodic full JSON of the delta mode and its resync stay with delta_full_interval
+        battery_dict_mqtt = build_payload(self._dbus_items)
+        if not connected.is_set() or not is_complete(battery_dict_mqtt, self._mqtt_topic):
+            return
+
+        payload_data = self._serializer.serialize(battery_dict_mqtt)
+        metrics.observe("payload_bytes", len(payload_data))
+        if self._publish_payload(payload_data, retain=mqtt_retain)[0] == 0:
+            logging.debug("Send keepalive `%s...` to topic `%s`", payload_data[0:50], self._mqtt_topic_payload)
+            self._last_publish = monotonic()
+            self._last_payload = battery_dict_mqtt
+            # the receiver has all current values, so the next delta starts from them
+            self._published.clear()
+            self._set_published(battery_dict_mqtt, self._published)
+
+    def _is_changed(self, path, value, published):
+        if path not in published:
+            return True
+
+        last_value = published[path]
+        if path in delta_deadbands and isinstance(value, (int, float)) and isinstance(last_value, (int, float)):
+            deadband, relative = delta_deadbands[path]
+            if relative:
+                deadband = abs(last_value) * deadband / 100
+            return abs(value - last_value) > deadband
+
+        return value != last_value
+
+    def _get_changes(self, battery_dict_mqtt, published):
+        battery_dict_changes = {}
+        for key, value in battery_dict_mqtt.items():
+            if isinstance(value, dict):
+                for subkey, subvalue in value.items():
+                    if self._is_changed(key + "/" + subkey, subvalue, published):
+                        battery_dict_changes.setdefault(key, {})[subkey] = subvalue
+            elif self._is_changed(key, value, published):
+                battery_dict_changes[key] = value
+        return battery_dict_changes
+
+    def _set_published(self, battery_dict_mqtt, published):
+        for key, value in battery_dict_mqtt.items():
+            if isinstance(value, dict):
+                for subkey, subvalue in value.items():
+                    published[key + "/" + subkey] = subvalue
+            else:
+                published[key] = value
+
+    def _replay(self):
+        # send the samples collected while the broker was not reachable in their original order
+        samples = self._offline_buffer.get()
+        sent = 0
+        for timestamp, sample in samples:
+            # not retained, the buffered samples are older than the current values
+            result = self._publish_message(
+                self._mqtt_topic_history, self._serializer.serialize(dict(sample, Timestamp=round(timestamp))), retain=False, properties=self._properties_replay
+            )
+            if result[0] != 0:
+                break
+            sent += 1
+
+        if sent == len(samples):
+            self._offline_buffer.clear()
+        else:
+            self._offline_buffer.remove(len(self._offline_buffer) - len(samples) + sent)
+        logging.info(f"Sent {sent} of {len(samples)} buffered samples to topic `{self._mqtt_topic_history}`")
+
+    def _publish_fanout(self, battery_dict_mqtt):
+        # publish each changed value to its own retained topic, the broker may have lost them on a reconnect
+        if self._full_pending:
+            self._fanout_published.clear()
+
+        for key, value in self._get_changes(battery_dict_mqtt, self._fanout_published).items():
+            if isinstance(value, dict):
+                for subkey, subvalue in value.items():
+                    self._publish_fanout_value(key + "/" + subkey, subvalue)
+            else:
+                self._publish_fanout_value(key, value)
+
+    def _publish_fanout_value(self, path, value):
+        # strings are sent as they are, all other values as JSON, e.g. 12.5 or true
+        result = self._publish_message(self._mqtt_topic + "/" + path, value if isinstance(value, str) else dumps(value))
+        if result[0] == 0:
+            self._fanout_published[path] = value
+
+    def _publish(self, battery_dict_mqtt, only_changes=False):
+        if not is_complete(battery_dict_mqtt, self._mqtt_topic):
+            metrics.inc("ticks_skipped")
+            return False
+
+        if not connected.is_set():
+            metrics.inc("ticks_skipped")
+            # keep the sample until the broker is reachable again
+            if self._offline_buffer is not None:
+                self._offline_buffer.add(battery_dict_mqtt)
+            return False
+
+        # send the buffered samples first, so the history is complete before the current values
+        if self._offline_buffer is not None and len(self._offline_buffer) > 0:
+            self._replay()
+
+        if fanout_enabled:
+            self._publish_fanout(battery_dict_mqtt)
+
+        full = self._full_pending or not delta_enabled
+        if full:
+            if only_changes and battery_dict_mqtt == self._last_payload and not self._full_pending:
+                return False
+            payload = battery_dict_mqtt
+        else:
+            payload = self._get_changes(battery_dict_mqtt, self._published)
+            if not payload:
+                return False
 
         # Push to MQTT
-        if connected:
-           if("Dc" in battery_dict_mqtt and "Soc" in battery_dict_mqtt):
-              if("Power" in battery_dict_mqtt["Dc"] and "Voltage" in battery_dict_mqtt["Dc"]):
-                 result = self._mqtt_client.publish(self._mqtt_topic, json.dumps(battery_dict_mqtt))
-                 if result[0] == 0:
-                    logging.debug(f"Send `{json.dumps(battery_dict_mqtt)[0:50]}...` to topic `{self._mqtt_topic}`")
-                 else:
-                    logging.debug(f"Failed to send message to topic {self._mqtt_topic}")
-              else:
-                 logging.debug(f"NOT Sending `{json.dumps(battery_dict_mqtt)[0:50]}...` to topic `{self._mqtt_topic}`, missing power or voltage")
-           else:
-              logging.debug(f"NOT Sending `{json.dumps(battery_dict_mqtt)[0:50]}...` to topic `{self._mqtt_topic}`, missing dc or Soc")
-              logging.debug(battery_dict_mqtt)
+        # serialize only once, the same data is used for the log
+        payload_data = self._serializer.serialize(payload)
+        metrics.observe("payload_bytes", len(payload_data))
+        # only the full JSON is retained, a retained delta would give a new subscriber an incomplete battery
+        result = self._publish_payload(payload_data, retain=mqtt_retain and full)
+        if result[0] == 0:
+            logging.debug("Send `%s...` to topic `%s`", payload_data[0:50], self._mqtt_topic_payload)
+            self._last_publish = monotonic()
+            if full:
+                self._published.clear()
+                self._last_payload = battery_dict_mqtt
+                self._full_pending = False
+                # replaces the stale marker of the watchdog
+                if self._status != "online":
+                    self._publish_message(self._mqtt_topic + "/Status", "online")
+                    self._status = "online"
+                    if startup_steps is not None:
+                        startup_step("first publish")
+                        log_startup()
+            self._set_published(payload, self._published)
+            return True
+        else:
+            logging.debug("Failed to send message to topic %s", self._mqtt_topic_payload)
+
+        return False
+
+
+class DbusMqttBatteryDiscovery:
+    def __init__(
+        self,
+        mqtt_topic,
+        mqtt_client,
+        dbus_conn,
+        serializer=None
+    ):
+
+        self._mqtt_topic = mqtt_topic
+        self._mqtt_client = mqtt_client
+        self._dbus_conn = dbus_conn
+        self._serializer = serializer
+        self._services = {}
+
+        # follow batteries appearing and disappearing, e.g. USB adapters enumerated as another tty
+        add_name_owner_changed_receiver(self._dbus_conn, self._on_name_owner_changed)
+
+        for name in self._dbus_conn.list_names():
+            self._add(str(name))
+
+    def _get_battery_path(self, name):
+        if not name.startswith("com.victronenergy.battery."):
+            return None
+
+        battery_path = name[len("com.victronenergy.battery."):]
+        if battery_path.startswith(battery_paths_exclude):
+            return None
+
+        return battery_path
+
+    def _add(self, name):
+        battery_path = self._get_battery_path(name)
+        if battery_path is None or battery_path in self._services:
+            return
+
+        logging.info(f"Found {name}, start sending it")
+        service = DbusMqttBatterySenderService(
+            battery_path=battery_path,
+            mqtt_topic=self._mqtt_topic.replace("{battery_path}", battery_path),
+            mqtt_client=self._mqtt_client,
+            dbus_conn=self._dbus_conn,
+            serializer=self._serializer
+        )
+        self._services[battery_path] = service
+        services.append(service)
+
+    def _remove(self, name):
+        battery_path = self._get_battery_path(name)
+        if battery_path is None or battery_path not in self._services:
+            return
+
+        service = self._services.pop(battery_path)
+        services.remove(service)
+        service.stop()
+
+    def _on_name_owner_changed(self, name, old_owner, new_owner):
+        name = str(name)
+        if new_owner == "":
+            self._remove(name)
+        else:
+            self._add(name)
+
+
+# the asyncio engine needs "pip install dbus-next aiomqtt", the modules are only imported when it is used
+if engine == "asyncio":
+    try:
+        import asyncio
+        import aiomqtt  # pyright: ignore[reportMissingImports]
+        from dbus_next import BusType, Message, MessageType  # pyright: ignore[reportMissingImports]
+        from dbus_next.aio import MessageBus  # pyright: ignore[reportMissingImports]
+        from dbus_next.errors import DBusError  # pyright: ignore[reportMissingImports]
+    except ImportError as err:
+        logging.error(f"engine = asyncio needs a python module, which is not installed: {err}. The driver restarts in 60 seconds.")
+        sleep(60)
+        sys.exit()
+
+
+# the event loop keeps only weak references to its tasks, so the started tasks are kept here until they are done
+background_tasks = set()
+
+
+def start_task(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(on_task_done)
+    return task
+
+
+def on_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"asyncio engine: {task.get_coro().__qualname__} failed", exc_info=task.exception())
+
+
+def unwrap_variant(value):
+    # dbus-next counterpart of unwrap_dbus_value, Variant objects have a signature and a value
+    if hasattr(value, "signature") and hasattr(value, "value"):
+        value = value.value
+    if isinstance(value, list):
+        # an empty array is an invalid value
+        return [unwrap_variant(x) for x in value] or None
+    if isinstance(value, dict):
+        return {x: unwrap_variant(y) for x, y in value.items()}
+    return value
+
+
+class AsyncBatterySender:
+    # asyncio engine: publishes the same payload as DbusMqttBatterySenderService in event mode,
+    # the battery is read with dbus-next and published with aiomqtt on the same event loop
+    def __init__(self, battery_path, mqtt_topic, engine):
+        self.battery_path = battery_path
+        self._mqtt_topic = mqtt_topic
+        self._engine = engine
+        self._serializer = engine.serializer
+
+        if self._serializer.name == "json":
+            self._mqtt_topic_payload = self._mqtt_topic
+        else:
+            self._mqtt_topic_payload = self._mqtt_topic + "/" + self._serializer.name
+        self.dbus_service = "com.victronenergy.battery." + self.battery_path
+
+        # unique name of the current owner, the signals are sent from it
+        self.owner = None
+        self._dbus_get_items = True
+        self._dbus_items = {}
+        self._dbus_items_loaded = False
+        self._last_dbus_update = None
+        self._last_payload = None
+        self._last_publish = monotonic()
+        self._full_pending = True
+        self._resync_pending = False
+        self._status = None
+        self._stopped = False
+        self._load_task = None
+        self._publish_scheduled = False
+        # keeps the order of the publishes, while one is waiting for the broker
+        self._publish_lock = asyncio.Lock()
+        if publish_rate_max > 0:
+            self._publish_rate_limit = TokenBucket(publish_rate_max, max(1, publish_rate_max))
+        else:
+            self._publish_rate_limit = None
+
+        # same signals as the GLib engine, the dbus daemon filters them by the well-known name
+        self._match_rules = []
+        match_rule = f"type='signal',sender='{self.dbus_service}',interface='com.victronenergy.BusItem'"
+        if include_paths and include_paths == include_paths_exact:
+            for include_path in include_paths:
+                self._match_rules.append(match_rule + f",member='PropertiesChanged',path='/{include_path}'")
+        else:
+            self._match_rules.append(match_rule + ",member='PropertiesChanged'")
+        self._match_rules.append(match_rule + ",member='ItemsChanged',path='/'")
+
+    @property
+    def name(self):
+        return self.dbus_service
+
+    async def start(self):
+        for match_rule in self._match_rules:
+            await self._engine.call_bus("AddMatch", "s", [match_rule])
+        self.load_or_retry()
+
+    async def stop(self):
+        self._stopped = True
+        self._engine.set_owner(self, None)
+        for match_rule in self._match_rules:
+            await self._engine.call_bus("RemoveMatch", "s", [match_rule])
+        logging.info(f"Stopped sending {self.dbus_service}")
+
+    def load_or_retry(self):
+        if self._load_task is None or self._load_task.done():
+            self._load_task = start_task(self._load_retry())
+
+    async def _load_retry(self):
+        # retry every 3 seconds until the battery is found
+        while not self._stopped and not await self._load():
+            await asyncio.sleep(3)
+
+    async def _load(self):
+        self._resync_pending = False
+        started = perf_counter()
+        try:
+            if self.owner is None:
+                self._engine.set_owner(self, (await self._engine.call_bus("GetNameOwner", "s", [self.dbus_service]))[0])
+            dbus_items = await self._get_items()
+        except DBusError:
+            self._engine.set_owner(self, None)
+            dbus_items = None
+        metrics.observe("dbus_read_seconds", perf_counter() - started)
+
+        if not isinstance(dbus_items, dict):
+            metrics.inc("dbus_read_errors")
+            logging.info("battery not (yet) found")
+            return False
+
+        self._last_dbus_update = time()
+        for dbus_path, dbus_value in dbus_items.items():
+            self._set_item(dbus_path, dbus_value)
+        if not self._dbus_items_loaded:
+            logging.info(f"Loaded {len(dbus_items)} paths from {self.dbus_service}")
+        self._dbus_items_loaded = True
+        return True
+
+    async def _get_items(self):
+        if self._dbus_get_items:
+            try:
+                items = (await self._engine.call(self.owner, "/", "com.victronenergy.BusItem", "GetItems"))[0]
+                dbus_items = {}
+                for dbus_path, item in items.items():
+                    dbus_path = dbus_path.lstrip("/")
+                    if "Value" in item and get_payload_path(dbus_path) is not None:
+                        dbus_items[dbus_path] = unwrap_variant(item["Value"])
+                return dbus_items
+            except DBusError as err:
+                dbus_items = unwrap_variant((await self._engine.call(self.owner, "/", "com.victronenergy.BusItem", "GetValue"))[0])
+                logging.info(f"{self.dbus_service} has no GetItems, using GetValue: {err.type}")
+                self._dbus_get_items = False
+                return dbus_items
+
+        return unwrap_variant((await self._engine.call(self.owner, "/", "com.victronenergy.BusItem", "GetValue"))[0])
+
+    def on_owner_changed(self, old_owner, new_owner):
+        logging.info(f"{self.dbus_service} changed owner from `{old_owner}` to `{new_owner}`")
+        self._engine.set_owner(self, None)
+        self._dbus_get_items = True
+        self._last_dbus_update = None
+        # values of the old owner are not valid anymore
+        self._dbus_items.clear()
+        self._dbus_items_loaded = False
+        if new_owner != "":
+            self.load_or_retry()
+
+    def on_properties_changed(self, path, changes):
+        self._last_dbus_update = time()
+        path = path.lstrip("/")
+        if "Value" in changes and get_payload_path(path) is not None:
+            self._set_item(path, unwrap_variant(changes["Value"]))
+
+    def on_items_changed(self, items):
+        self._last_dbus_update = time()
+        for dbus_path, changes in items.items():
+            dbus_path = dbus_path.lstrip("/")
+            if "Value" in changes and get_payload_path(dbus_path) is not None:
+                self._set_item(dbus_path, unwrap_variant(changes["Value"]))
+
+    def _set_item(self, dbus_path, dbus_value):
+        if dbus_path == "" or get_payload_path(dbus_path) is None:
+            return
+        if dbus_path in self._dbus_items and self._dbus_items[dbus_path] == dbus_value:
+            return
+
+        self._dbus_items[dbus_path] = dbus_value
+        self._schedule_publish()
+
+    def request_full_snapshot(self):
+        self._full_pending = True
+        self._resync_pending = True
+        self._schedule_publish()
+
+    def keepalive(self, now):
+        # publishes the full JSON again without a resync, if nothing was published for keepalive_interval,
+        # returns the seconds until the next check
+        idle = now - self._last_publish
+        if idle < keepalive_interval:
+            return keepalive_interval - idle
+        if not self._publish_scheduled:
+            self._full_pending = True
+            self._schedule_publish()
+        return keepalive_interval
+
+    def _schedule_publish(self):
+        # collect all changes of the publish window into one publish
+        if not self._publish_scheduled:
+            self._publish_scheduled = True
+            start_task(self._publish_later())
+
+    async def _publish_later(self):
+        try:
+            await asyncio.sleep(publish_window / 1000)
+
+            if self._publish_rate_limit is not None:
+                wait = self._publish_rate_limit.get_wait()
+                while wait > 0:
+                    # all changes until the next token are merged into this publish
+                    metrics.inc("publishes_rate_limited")
+                    await asyncio.sleep(wait)
+                    wait = self._publish_rate_limit.get_wait()
+
+            if self._stopped:
+                return
+
+            # resync the mirror with one bulk read before the full JSON, only once per request and not while offline,
+            # still scheduled, so the changes found by the resync do not schedule another publish
+            if self._resync_pending and self._dbus_items_loaded and self._engine.is_connected():
+                await self._load()
+        finally:
+            # also after an unexpected error, else the next change would not schedule a publish anymore
+            self._publish_scheduled = False
+
+        async with self._publish_lock:
+            if await self._publish(build_payload(self._dbus_items)) and self._publish_rate_limit is not None:
+                self._publish_rate_limit.take()
+
+    async def _publish(self, battery_dict_mqtt):
+        if not is_complete(battery_dict_mqtt, self._mqtt_topic):
+            metrics.inc("ticks_skipped")
+            return False
+
+        if not self._engine.is_connected():
+            metrics.inc("ticks_skipped")
+            return False
+
+        # like the GLib engine without delta mode, publish only if a value changed or the full JSON is requested
+        if not self._full_pending and battery_dict_mqtt == self._last_payload:
+            return False
+
+        payload_data = self._serializer.serialize(battery_dict_mqtt)
+        metrics.observe("payload_bytes", len(payload_data))
+        if not await self._engine.publish(self._mqtt_topic_payload, payload_data, retain=mqtt_retain):
+            logging.debug("Failed to send message to topic %s", self._mqtt_topic_payload)
+            return False
+
+        logging.debug("Send `%s...` to topic `%s`", payload_data[0:50], self._mqtt_topic_payload)
+        self._last_payload = battery_dict_mqtt
+        self._last_publish = monotonic()
+        self._full_pending = False
+        # replaces the stale marker of the watchdog
+        if self._status != "online":
+            await self._engine.publish(self._mqtt_topic + "/Status", "online")
+            self._status = "online"
+            if startup_steps is not None:
+                startup_step("first publish")
+                log_startup()
+        return True
+
+    def is_stale(self, now):
+        if self._stopped or self._last_dbus_update is None:
+            return False
+
+        age = now - self._last_dbus_update
+        if age > timeout / 2:
+            # no signal for a while, check if the battery still answers
+            self.load_or_retry()
+
+        return age > timeout
+
+    async def publish_stale(self):
+        await self._engine.publish(self._mqtt_topic + "/Status", "stale")
+        self._status = "stale"
+        # an empty payload removes the retained message
+        if mqtt_retain:
+            await self._engine.publish(self._mqtt_topic_payload, None)
+
+
+class AsyncEngine:
+    # runs all batteries and the MQTT client on one asyncio event loop
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self._bus = None
+        self._mqtt = None
+        self._senders = {}
+        # unique name -> sender, the signals are sent from the unique name
+        self._owners = {}
+        # aiomqtt has no message ids, numbered here for the publish tracker
+        self._publish_count = 0
+
+    async def run(self):
+        self._bus = await MessageBus(bus_type=BusType.SESSION if "DBUS_SESSION_BUS_ADDRESS" in os.environ else BusType.SYSTEM).connect()
+        self._bus.add_message_handler(self._on_message)
+
+        # the MQTT client connects while the batteries are loaded
+        tasks = [asyncio.ensure_future(self._run_mqtt())]
+
+        await self.call_bus("AddMatch", "s", ["type='signal',sender='org.freedesktop.DBus',interface='org.freedesktop.DBus',member='NameOwnerChanged',arg0namespace='com.victronenergy'"])
+        if battery_paths == ["auto"]:
+            for name in (await self.call_bus("ListNames"))[0]:
+                await self._add(name)
+        else:
+            for battery_path, mqtt_topic in zip(battery_paths, mqtt_topics):
+                sender = AsyncBatterySender(battery_path, mqtt_topic, self)
+                self._senders[battery_path] = sender
+                services.append(sender)
+                await sender.start()
+        startup_step("dbus")
+
+        if timeout > 0:
+            tasks.append(asyncio.ensure_future(self._watchdog()))
+        if keepalive_interval > 0:
+            tasks.append(asyncio.ensure_future(self._keepalive()))
+        tasks.append(asyncio.ensure_future(self._log_stats()))
+        if metrics_topic != "" and metrics_interval > 0:
+            tasks.append(asyncio.ensure_future(self._publish_metrics()))
+
+        logging.info("Connected to dbus and switching over to the asyncio event loop")
+        await asyncio.gather(*tasks)
+
+    async def call(self, destination, path, interface, member, signature="", body=None):
+        reply = await self._bus.call(Message(destination=destination, path=path, interface=interface, member=member, signature=signature, body=body or []))
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, reply.body[0] if reply.body else "")
+        return reply.body
+
+    async def call_bus(self, member, signature="", body=None):
+        return await self.call("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus", member, signature, body)
+
+    def set_owner(self, sender, owner):
+        if sender.owner is not None:
+            self._owners.pop(sender.owner, None)
+        sender.owner = owner
+        if owner is not None:
+            self._owners[owner] = sender
+
+    def _on_message(self, message):
+        # returns None, else dbus-next sends the return value as reply
+        if message.message_type != MessageType.SIGNAL:
+            return None
+
+        if message.interface == "com.victronenergy.BusItem":
+            sender = self._owners.get(message.sender)
+            if sender is None:
+                return None
+            if message.member == "PropertiesChanged":
+                sender.on_properties_changed(message.path, message.body[0])
+            elif message.member == "ItemsChanged" and message.path == "/":
+                sender.on_items_changed(message.body[0])
+        elif message.member == "NameOwnerChanged" and message.sender == "org.freedesktop.DBus":
+            name, old_owner, new_owner = message.body
+            for sender in list(self._senders.values()):
+                if sender.dbus_service == name:
+                    if battery_paths == ["auto"] and new_owner == "":
+                        start_task(self._remove(sender))
+                    else:
+                        sender.on_owner_changed(old_owner, new_owner)
+                    return None
+            if battery_paths == ["auto"] and new_owner != "":
+                start_task(self._add(name))
+        return None
+
+    async def _add(self, name):
+        if not name.startswith("com.victronenergy.battery."):
+            return
+
+        battery_path = name[len("com.victronenergy.battery."):]
+        if battery_path.startswith(battery_paths_exclude) or battery_path in self._senders:
+            return
+
+        logging.info(f"Found {name}, start sending it")
+        sender = AsyncBatterySender(battery_path, mqtt_topics[0].replace("{battery_path}", battery_path), self)
+        self._senders[battery_path] = sender
+        services.append(sender)
+        await sender.start()
+
+    async def _remove(self, sender):
+        self._senders.pop(sender.battery_path, None)
+        if sender in services:
+            services.remove(sender)
+        await sender.stop()
+
+    def is_connected(self):
+        return self._mqtt is not None
+
+    async def publish(self, topic, payload, retain=True):
+        if self._mqtt is None:
+            return False
+        self._publish_count += 1
+        mid = self._publish_count
+        # counted like the publishes of paho, so the metrics and the watchdog work the same for both engines
+        publish_tracker.add((0, mid))
+        try:
+            # returns after the message is sent, with QoS 1 and 2 after the acknowledge
+            await self._mqtt.publish(topic, payload, qos=mqtt_qos, retain=retain)
+        except aiomqtt.MqttError as err:
+            logging.warning(f"MQTT client: Publish to {topic} failed: {err}")
+            publish_tracker.fail(mid)
+            return False
+        publish_tracker.on_publish(mid)
         return True
 
+    async def _run_mqtt(self):
+        global mqtt_connection_count
+
+        tls_enabled, tls_path_to_ca, tls_insecure, username, password = get_mqtt_settings()
+        tls_context = None
+        if tls_enabled:
+            import ssl
+
+            tls_context = ssl.create_default_context(cafile=tls_path_to_ca)
+            if tls_insecure:
+                tls_context.check_hostname = False
+
+        logging.info(f"MQTT client: Connecting to broker {config['MQTT']['broker_address']} on port {config['MQTT']['broker_port']}")
+        # random start delay, so several drivers do not retry in lock-step after a broker restart
+        reconnect_delay = reconnect_delay_min + random.uniform(0, reconnect_delay_min)
+        while True:
+            try:
+                async with aiomqtt.Client(
+                    hostname=config["MQTT"]["broker_address"],
+                    port=int(config["MQTT"]["broker_port"]),
+                    identifier="MqttBatterySender_" + get_portal_id() + "_" + "_".join(battery_paths),
+                    username=username,
+                    password=password,
+                    tls_context=tls_context,
+                    tls_insecure=tls_insecure or None,
+                    max_inflight_messages=mqtt_max_inflight_messages,
+                    max_queued_outgoing_messages=mqtt_max_queued_messages,
+                ) as client:
+                    logging.info("MQTT client: Connected to MQTT broker!")
+                    if mqtt_connection_count == 0:
+                        startup_step("connected")
+                    mqtt_connection_count += 1
+                    # with a new random part for the next outage, else all drivers retry in lock-step again
+                    reconnect_delay = reconnect_delay_min + random.uniform(0, reconnect_delay_min)
+                    self._mqtt = client
+                    # the broker may have lost the retained state, so start with the full JSON
+                    for sender in self._senders.values():
+                        sender.request_full_snapshot()
+                    # nothing is subscribed, the iteration ends with an MqttError when the connection is lost
+                    async for _ in client.messages:
+                        pass
+            except aiomqtt.MqttError as err:
+                if self._mqtt is not None:
+                    logging.warning(f"MQTT client: Unexpected MQTT disconnection: {err}. Will auto-reconnect")
+                else:
+                    logging.error(f"MQTT client: Failed to connect: {err}")
+            self._mqtt = None
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, reconnect_delay_max)
+
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(max(1, timeout // 10))
+            now = time()
+            stale_senders = [sender for sender in self._senders.values() if sender.is_stale(now)]
+
+            # same checks as watchdog() of the GLib engine, while disconnected the reconnect is handled by _run_mqtt
+            if self.is_connected() and publish_tracker.get_unacked_age(now) > timeout:
+                logging.error(f"MQTT client: No publish was acknowledged for {timeout} seconds")
+                stale_senders = list(self._senders.values())
+            elif stale_senders:
+                logging.error(f"No dbus update for {timeout} seconds from: {', '.join(sender.name for sender in stale_senders)}")
+
+            if stale_senders:
+                for sender in stale_senders:
+                    await sender.publish_stale()
+                logging.error("The driver restarts in 1 second.")
+                await asyncio.sleep(1)
+                os._exit(1)
+
+    async def _keepalive(self):
+        # same as the keepalive timer of the GLib engine in event mode
+        while True:
+            now = monotonic()
+            wait = keepalive_interval
+            for sender in list(self._senders.values()):
+                wait = min(wait, sender.keepalive(now))
+            await asyncio.sleep(max(1, wait))
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(300)
+            publish_tracker.log_stats()
+
+    async def _publish_metrics(self):
+        while True:
+            await asyncio.sleep(metrics_interval)
+            await self.publish(metrics_topic, dumps(metrics.as_dict()), retain=False)
+
+
+def run_asyncio(serializer):
+    ignored = [
+        name for name, used in (
+            ("update_mode = poll", update_mode == "poll"),
+            ("delta_enabled", delta_enabled),
+            ("fanout_enabled", fanout_enabled),
+            ("offline_buffer_size", offline_buffer_size > 0),
+            ("protocol_version = 5", mqtt_v5),
+            ("command_paths", bool(command_paths)),
+        ) if used
+    ]
+    if ignored:
+        logging.warning(f"Not supported by engine = asyncio and ignored: {', '.join(ignored)}")
+
+    if metrics_port > 0:
+        start_metrics_server()
+
+    asyncio.run(AsyncEngine(serializer).run())
+
 
 def main():
     _thread.daemon = True  # allow the program to quit
 
-    from dbus.mainloop.glib import (
-        DBusGMainLoop,
-    )  # pyright: ignore[reportMissingImports]
+    # payload format, shared by all batteries
+    try:
+        serializer = serializers[payload_format]()
+    except KeyError:
+        logging.error(f'Unknown payload_format "{payload_format}", use one of: {", ".join(serializers)}. The driver restarts in 60 seconds.')
+        sleep(60)
+        sys.exit()
+    except ImportError as err:
+        logging.error(f'The payload_format "{payload_format}" needs a python module, which is not installed: {err}. The driver restarts in 60 seconds.')
+        sleep(60)
+        sys.exit()
 
-    # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
-    DBusGMainLoop(set_as_default=True)
+    if engine == "asyncio":
+        run_asyncio(serializer)
+        return
 
     # MQTT setup
-    client = mqtt.Client("MqttBatterySender_" + get_vrm_portal_id() + "_" + str(config["DEFAULT"]["battery_path"]))
+    client = mqtt.Client("MqttBatterySender_" + get_portal_id() + "_" + "_".join(battery_paths), protocol=mqtt.MQTTv5 if mqtt_v5 else mqtt.MQTTv311)
     client.on_disconnect = on_disconnect
     client.on_connect = on_connect
+    client.on_publish = on_publish
+    client.max_inflight_messages_set(mqtt_max_inflight_messages)
+    client.max_queued_messages_set(mqtt_max_queued_messages)
 
     # check tls and use settings, if provided
-    if "tls_enabled" in config["MQTT"] and config["MQTT"]["tls_enabled"] == "1":
-        logging.info("MQTT client: TLS is enabled")
-
-        if "tls_path_to_ca" in config["MQTT"] and config["MQTT"]["tls_path_to_ca"] != "":
-            logging.info('MQTT client: TLS: custom ca "%s" used' % config["MQTT"]["tls_path_to_ca"])
-            client.tls_set(config["MQTT"]["tls_path_to_ca"], tls_version=2)
-        else:
-            client.tls_set(tls_version=2)
-
-        if "tls_insecure" in config["MQTT"] and config["MQTT"]["tls_insecure"] != "":
-            logging.info("MQTT client: TLS certificate server hostname verification disabled")
+    tls_enabled, tls_path_to_ca, tls_insecure, username, password = get_mqtt_settings()
+    if tls_enabled:
+        client.tls_set(tls_path_to_ca, tls_version=2)
+        if tls_insecure:
             client.tls_insecure_set(True)
 
-    # check if username and password are set
-    if "username" in config["MQTT"] and "password" in config["MQTT"] and config["MQTT"]["username"] != "" and config["MQTT"]["password"] != "":
-        logging.info('MQTT client: Using username "%s" and password to connect' % config["MQTT"]["username"])
-        client.username_pw_set(username=config["MQTT"]["username"], password=config["MQTT"]["password"])
+    if username is not None:
+        client.username_pw_set(username=username, password=password)
 
     # connect to broker
     logging.info(f"MQTT client: Connecting to broker {config['MQTT']['broker_address']} on port {config['MQTT']['broker_port']}")
-    client.connect(host=config["MQTT"]["broker_address"], port=int(config["MQTT"]["broker_port"]))
+    # random start delay, so several drivers do not retry in lock-step after a broker restart
+    client.reconnect_delay_set(min_delay=reconnect_delay_min + random.uniform(0, reconnect_delay_min), max_delay=reconnect_delay_max)
+    # connect in the network thread of paho, which also reconnects if the broker is not (yet) reachable
+    client.connect_async(host=config["MQTT"]["broker_address"], port=int(config["MQTT"]["broker_port"]))
     client.loop_start()
+    startup_step("mqtt")
 
-    DbusMqttBatterySenderService(
-        battery_path=config["DEFAULT"]["battery_path"],
-        mqtt_topic=config["MQTT"]["topic"],
-        mqtt_client=client
-    )
+    # the dbus setup runs while the network thread of paho connects to the broker
+    from dbus.mainloop.glib import (
+        DBusGMainLoop,
+    )  # pyright: ignore[reportMissingImports]
+
+    # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
+    DBusGMainLoop(set_as_default=True)
+
+    # D-Bus connection, shared for the whole lifetime of the driver
+    dbus_conn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+
+    # one service per battery, all share the same D-Bus connection and MQTT client
+    if battery_paths == ["auto"]:
+        DbusMqttBatteryDiscovery(
+            mqtt_topic=mqtt_topics[0],
+            mqtt_client=client,
+            dbus_conn=dbus_conn,
+            serializer=serializer
+        )
+    else:
+        for battery_path, mqtt_topic in zip(battery_paths, mqtt_topics):
+            services.append(
+                DbusMqttBatterySenderService(
+                    battery_path=battery_path,
+                    mqtt_topic=mqtt_topic,
+                    mqtt_client=client,
+                    dbus_conn=dbus_conn,
+                    serializer=serializer
+                )
+            )
+
+    startup_step("dbus")
+
+    if timeout > 0:
+        GLib.timeout_add_seconds(max(1, timeout // 10), watchdog)
+
+    GLib.timeout_add_seconds(300, publish_tracker.log_stats)
+
+    if metrics_port > 0:
+        start_metrics_server()
+    if metrics_topic != "" and metrics_interval > 0:
+        GLib.timeout_add_seconds(metrics_interval, publish_metrics, client)
 
     logging.info("Connected to dbus and switching over to GLib.MainLoop() (= event based)")
     mainloop = GLib.MainLoop()
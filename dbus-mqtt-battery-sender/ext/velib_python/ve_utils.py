@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import sys
+from array import array
 from traceback import print_exc
 from os import _exit as os_exit
 from os import statvfs
@@ -235,15 +236,62 @@ def wrap_dbus_value(value):
 dbus_int_types = (dbus.Int32, dbus.UInt32, dbus.Byte, dbus.Int16, dbus.UInt16, dbus.UInt32, dbus.Int64, dbus.UInt64)
 
 
-def unwrap_dbus_value(val):
+# Converters of the scalar types by exact type, so unwrap_dbus_value needs one dict lookup instead of a chain of
+# isinstance checks. Subclasses and all other types are handled by _unwrap_dbus_value_other.
+_unwrap_scalars = {
+	dbus.Int16: int,
+	dbus.UInt16: int,
+	dbus.Int32: int,
+	dbus.UInt32: int,
+	dbus.Int64: int,
+	dbus.UInt64: int,
+	# Python has no byte type, so we convert to an integer.
+	dbus.Byte: int,
+	dbus.Double: float,
+	dbus.Boolean: bool,
+	dbus.String: str,
+	dbus.Signature: str,
+	int: int,
+	float: float,
+	bool: bool,
+	str: str,
+}
+
+# Signatures of the arrays, which are converted to array('d') with numeric_arrays=True
+_numeric_signatures = frozenset(['y', 'n', 'q', 'i', 'u', 'x', 't', 'd'])
+
+
+def unwrap_dbus_value(val, numeric_arrays=False):
 	"""Converts D-Bus values back to the original type. For example if val is of type DBus.Double,
-	a float will be returned."""
+	a float will be returned. With numeric_arrays=True, arrays of numbers are returned as array('d')
+	instead of a list."""
+	converter = _unwrap_scalars.get(type(val))
+	if converter is not None:
+		return converter(val)
+	if type(val) is dbus.Dictionary or type(val) is dict:
+		# Flat trees like the one of a root GetValue are converted in one pass.
+		# Do not unwrap the keys, see comment in wrap_dbus_value
+		result = {}
+		for x, y in val.items():
+			converter = _unwrap_scalars.get(type(y))
+			result[x] = converter(y) if converter is not None else unwrap_dbus_value(y, numeric_arrays)
+		return result
+	if type(val) is dbus.Array:
+		if len(val) == 0:
+			return None
+		if numeric_arrays and val.signature in _numeric_signatures:
+			return array('d', val)
+		return [unwrap_dbus_value(x, numeric_arrays) for x in val]
+	return _unwrap_dbus_value_other(val, numeric_arrays)
+
+
+def _unwrap_dbus_value_other(val, numeric_arrays):
 	if isinstance(val, dbus_int_types):
 		return int(val)
 	if isinstance(val, dbus.Double):
 		return float(val)
 	if isinstance(val, dbus.Array):
-		v = [unwrap_dbus_value(x) for x in val]
+		v = [unwrap_dbus_value(x, numeric_arrays) for x in val]
 		return None if len(v) == 0 else v
 	if isinstance(val, (dbus.Signature, dbus.String)):
 		return str(val)
@@ -253,10 +301,10 @@ def unwrap_dbus_value(val):
 	if isinstance(val, dbus.ByteArray):
 		return "".join([bytes(x) for x in val])
 	if isinstance(val, (list, tuple)):
-		return [unwrap_dbus_value(x) for x in val]
+		return [unwrap_dbus_value(x, numeric_arrays) for x in val]
 	if isinstance(val, (dbus.Dictionary, dict)):
 		# Do not unwrap the keys, see comment in wrap_dbus_value
-		return dict([(x, unwrap_dbus_value(y)) for x, y in val.items()])
+		return {x: unwrap_dbus_value(y, numeric_arrays) for x, y in val.items()}
 	if isinstance(val, dbus.Boolean):
 		return bool(val)
 	return val
@@ -266,11 +314,12 @@ def unwrap_dbus_value(val):
 def add_name_owner_changed_receiver(dbus, name_owner_changed, namespace="com.victronenergy"):
 	# support for arg0namespace is submitted upstream, but not included at the time of
 	# writing, Venus OS does support it, so try if it works.
+	# Returns the signal match, so the receiver can be removed again.
 	if namespace is None:
-		dbus.add_signal_receiver(name_owner_changed, signal_name='NameOwnerChanged')
+		return dbus.add_signal_receiver(name_owner_changed, signal_name='NameOwnerChanged')
 	else:
 		try:
-			dbus.add_signal_receiver(name_owner_changed,
+			return dbus.add_signal_receiver(name_owner_changed,
 				signal_name='NameOwnerChanged', arg0namespace=namespace)
 		except TypeError:
-			dbus.add_signal_receiver(name_owner_changed, signal_name='NameOwnerChanged')
+			return dbus.add_signal_receiver(name_owner_changed, signal_name='NameOwnerChanged')
@@ -0,0 +1,227 @@
+# Fakes of dbus-python, PyGObject and paho-mqtt for the tests of dbus-mqtt-battery-sender
+# The D-Bus connection, the GLib main loop and the MQTT clients are replaced by small fakes, so no dbus daemon or
+# broker is needed. dbus-python, PyGObject and paho-mqtt are only replaced, if they are not installed.
+
+import asyncio
+import importlib.util
+import itertools
+import shutil
+import sys
+import types
+from pathlib import Path
+
+import pytest
+
+DRIVER_DIR = Path(__file__).resolve().parent.parent / "dbus-mqtt-battery-sender"
+TOPIC = "test/battery"
+
+CONFIG = f"""
+[DEFAULT]
+logging = ERROR
+battery_path = test
+timeout = 0
+keepalive_interval = 0
+
+[MQTT]
+broker_address = 127.0.0.1
+broker_port = 1883
+topic = {TOPIC}
+publish_window = 0
+"""
+
+GET_ITEMS = {
+    "/Dc/0/Power": 120.5,
+    "/Dc/0/Voltage": 53.2,
+    "/Dc/0/Current": 2.3,
+    "/Soc": 81,
+    "/Voltages/Cell1": 3.325,
+    "/Voltages/Cell2": 3.327,
+    "/System/MinCellVoltage": 3.325,
+    "/Serial": "skipped",
+    "/ProductName": "skipped",
+    "/Alarms/LowVoltage": 0,
+}
+
+
+def fake_dbus_type(name, base):
+    # the dbus-python types accept signature and variant_level
+    if base in (list, dict):
+
+        def __init__(self, value=(), signature=None, variant_level=0):
+            base.__init__(self, value)
+            self.signature = signature
+
+        return type(name, (base,), {"__init__": __init__})
+    return type(name, (base,), {"__new__": lambda cls, value=base(), *args, **kwargs: base.__new__(cls, value)})
+
+
+def install_fake_modules():
+    # only the parts used on import of the driver and vedbus
+    try:
+        import gi.repository.GLib  # noqa: F401
+    except ImportError:
+        gi = types.ModuleType("gi")
+        gi.repository = types.ModuleType("gi.repository")
+        gi.repository.GLib = types.ModuleType("gi.repository.GLib")
+        sys.modules.update({"gi": gi, "gi.repository": gi.repository, "gi.repository.GLib": gi.repository.GLib})
+
+    try:
+        import dbus.service  # noqa: F401
+    except ImportError:
+        dbus = types.ModuleType("dbus")
+        for name, base in (
+            ("Int16", int), ("UInt16", int), ("Int32", int), ("UInt32", int), ("Int64", int), ("UInt64", int), ("Byte", int),
+            ("Double", float), ("Boolean", int), ("String", str), ("Signature", str), ("ObjectPath", str),
+            ("Array", list), ("ByteArray", bytes), ("Dictionary", dict), ("Struct", tuple),
+        ):
+            setattr(dbus, name, fake_dbus_type(name, base))
+        dbus.exceptions = types.ModuleType("dbus.exceptions")
+        dbus.exceptions.DBusException = type("DBusException", (Exception,), {"get_dbus_name": lambda self: "org.freedesktop.DBus.Error.Failed"})
+        dbus.service = types.ModuleType("dbus.service")
+        dbus.service.Object = object
+        dbus.service.BusName = object
+        dbus.service.method = dbus.service.signal = lambda *args, **kwargs: (lambda function: function)
+        sys.modules.update({"dbus": dbus, "dbus.exceptions": dbus.exceptions, "dbus.service": dbus.service})
+
+    try:
+        import paho.mqtt.client  # noqa: F401
+    except ImportError:
+        paho = types.ModuleType("paho")
+        paho.mqtt = types.ModuleType("paho.mqtt")
+        paho.mqtt.client = types.ModuleType("paho.mqtt.client")
+        paho.mqtt.client.Client = object
+        paho.mqtt.client.MQTTv311 = 4
+        paho.mqtt.client.MQTTv5 = 5
+        sys.modules.update({"paho": paho, "paho.mqtt": paho.mqtt, "paho.mqtt.client": paho.mqtt.client})
+
+
+@pytest.fixture(scope="session")
+def driver(tmp_path_factory):
+    # the driver reads config.ini next to itself on import
+    driver_dir = tmp_path_factory.mktemp("driver") / "dbus-mqtt-battery-sender"
+    shutil.copytree(DRIVER_DIR, driver_dir, ignore=shutil.ignore_patterns("config.ini", "__pycache__"))
+    (driver_dir / "config.ini").write_text(CONFIG)
+
+    install_fake_modules()
+    spec = importlib.util.spec_from_file_location("dbus_mqtt_battery_sender", driver_dir / "dbus-mqtt-battery-sender.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # the asyncio modules are only imported with engine = asyncio, dbus-next and aiomqtt are not needed for the fakes
+    module.asyncio = asyncio
+    module.DBusError = type("DBusError", (Exception,), {})
+    module.aiomqtt = types.SimpleNamespace(MqttError=type("MqttError", (Exception,), {}))
+    return module
+
+
+class FakeGLib:
+    # runs the idle and timeout callbacks on request, the timers of timeout_add_seconds are only recorded
+    def __init__(self):
+        self.callbacks = []
+        self.timers = []
+
+    def timeout_add(self, interval, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def idle_add(self, callback, *args):
+        self.callbacks.append((callback, args))
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        self.timers.append((interval, callback, args))
+
+    def run_pending(self):
+        while self.callbacks:
+            callback, args = self.callbacks.pop(0)
+            callback(*args)
+
+
+class FakeMatch:
+    def remove(self):
+        pass
+
+
+class FakeProxy:
+    def __init__(self, items):
+        self.items = items
+
+    def GetItems(self, dbus_interface=None):
+        return {path: {"Value": value, "Text": str(value)} for path, value in self.items.items()}
+
+
+class FakeDbusConnection:
+    def __init__(self, items):
+        self.items = items
+        self.receivers = {}
+
+    def get_object(self, bus_name, path, introspect=True):
+        return FakeProxy(self.items)
+
+    def add_signal_receiver(self, handler, signal_name=None, **kwargs):
+        self.receivers[signal_name] = handler
+        return FakeMatch()
+
+
+class FakeMqttClient:
+    # acknowledges every message at once, paho calls on_publish from its network thread
+    mids = itertools.count(1000)
+
+    def __init__(self, on_publish):
+        self.messages = []
+        self.on_publish = on_publish
+        self.subscriptions = set()
+        self.callbacks = {}
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self.messages.append((topic, payload, retain))
+        mid = next(self.mids)
+        self.on_publish(self, None, mid)
+        return (0, mid)
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+
+    def unsubscribe(self, topic):
+        self.subscriptions.discard(topic)
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def message_callback_remove(self, topic):
+        self.callbacks.pop(topic, None)
+
+
+class FakeAsyncMqttClient:
+    def __init__(self):
+        self.messages = []
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages.append((topic, payload, retain))
+
+
+class Variant:
+    # dbus-next wraps every value of a{sv} in a Variant
+    def __init__(self, value):
+        self.signature = "v"
+        self.value = value
+
+
+@pytest.fixture
+def glib_battery(driver):
+    # starts DbusMqttBatterySenderService on the fakes, returns the service, the dbus connection and the MQTT client
+    started = []
+
+    def start(items=GET_ITEMS, connected=True, battery_path="test", mqtt_topic=TOPIC):
+        driver.GLib = FakeGLib()
+        if connected:
+            driver.connected.set()
+        dbus_conn = FakeDbusConnection(items)
+        client = FakeMqttClient(driver.on_publish)
+        service = driver.DbusMqttBatterySenderService(battery_path=battery_path, mqtt_topic=mqtt_topic, mqtt_client=client, dbus_conn=dbus_conn)
+        started.append(service)
+        driver.GLib.run_pending()
+        return service, dbus_conn, client
+
+    yield start
+    for service in started:
+        service.stop()
+    driver.connected.clear()
@@ -0,0 +1,31 @@
+# Tasks of the asyncio engine
+
+import asyncio
+
+from conftest import TOPIC, FakeAsyncMqttClient
+
+
+def test_publish_scheduled_after_error(driver, caplog):
+    async def run():
+        engine = driver.AsyncEngine(driver.JsonSerializer())
+        engine._mqtt = FakeAsyncMqttClient()
+        sender = driver.AsyncBatterySender("test", TOPIC, engine)
+        sender._dbus_items_loaded = True
+        sender._resync_pending = True
+
+        async def load():
+            raise RuntimeError("bus connection lost")
+
+        sender._load = load
+        sender._schedule_publish()
+        assert len(driver.background_tasks) == 1
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        # the next change schedules a publish again
+        assert not sender._publish_scheduled
+        assert not driver.background_tasks
+
+    asyncio.run(run())
+    assert "_publish_later failed" in caplog.text
+    assert "bus connection lost" in caplog.text
@@ -0,0 +1,43 @@
+# cell_format: cell voltages and balance flags packed into lists
+
+import pytest
+
+
+def test_pack_cells(driver):
+    assert driver.pack_cells({"Cell1": 3.301, "Cell2": 3.305, "Sum": 6.606}) == {"Sum": 6.606, "Cells": [3.301, 3.305]}
+    # missing cells are None, so the index stays the cell number - 1, Cell0 is no cell
+    assert driver.pack_cells({"Cell3": 3.3, "Cell1": 3.2, "Cell0": 1, "Cellx": 2}) == {"Cell0": 1, "Cellx": 2, "Cells": [3.2, None, 3.3]}
+    assert driver.pack_cells({}) == {"Cells": []}
+
+
+def test_pack_cells_aggregates(driver):
+    assert driver.pack_cells({"Cell1": 3.301, "Cell2": 3.305, "Cell4": 3.3}, aggregates=True) == {
+        "Cells": [3.301, 3.305, None, 3.3],
+        "Min": 3.3,
+        "Max": 3.305,
+        "Delta": 0.005,
+        "Avg": 3.302,
+    }
+    assert driver.pack_cells({"Cell1": 3.301, "Cell2": 3.305}, millivolts=True, aggregates=True) == {
+        "Cells": [3301, 3305],
+        "Min": 3301,
+        "Max": 3305,
+        "Delta": 4,
+        "Avg": 3303,
+    }
+    # no number, no aggregates
+    assert driver.pack_cells({"Cell1": None}, aggregates=True) == {"Cells": [None]}
+
+
+@pytest.mark.parametrize("cell_format, voltages", [
+    ("keys", {"Cell1": 3.325, "Cell2": 3.327}),
+    ("array", {"Cells": [3.325, 3.327], "Min": 3.325, "Max": 3.327, "Delta": 0.002, "Avg": 3.326}),
+    ("array_mv", {"Cells": [3325, 3327], "Min": 3325, "Max": 3327, "Delta": 2, "Avg": 3326}),
+])
+def test_build_payload_cell_format(driver, monkeypatch, cell_format, voltages):
+    monkeypatch.setattr(driver, "cell_format", cell_format)
+    payload = driver.build_payload({"Voltages/Cell1": 3.325, "Voltages/Cell2": 3.327, "Balances/Cell1": 0, "Balances/Cell2": 1})
+
+    assert payload["Voltages"] == voltages
+    # balance flags are never converted and have no aggregates
+    assert payload["Balances"] == ({"Cell1": 0, "Cell2": 1} if cell_format == "keys" else {"Cells": [0, 1]})
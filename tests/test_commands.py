@@ -0,0 +1,93 @@
+# Values received on <topic>/set/<path> are written to the battery and acknowledged on <topic>/ack/<path>
+
+import json
+import types
+
+import pytest
+
+from conftest import TOPIC
+
+
+class FakeItemImport:
+    # records the values written with SetValue, result is the return value of the battery service
+    writes = []
+    result = 0
+
+    def __init__(self, dbus_conn, service_name, path, createsignal=True):
+        self.path = path
+
+    def set_value(self, value):
+        if isinstance(self.result, Exception):
+            raise self.result
+        self.writes.append((self.path, value))
+        return self.result
+
+
+@pytest.fixture
+def commands(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "command_paths", frozenset(["Info/MaxChargeCurrent"]))
+    monkeypatch.setattr(driver, "VeDbusItemImport", FakeItemImport)
+    monkeypatch.setattr(FakeItemImport, "writes", [])
+    monkeypatch.setattr(FakeItemImport, "result", 0)
+    service, _, client = glib_battery()
+    assert client.subscriptions == {TOPIC + "/set/#"}
+    client.messages.clear()
+
+    def send(*commands, retain=False):
+        # all commands of one call are applied in the same main loop iteration
+        for path, payload in commands:
+            client.callbacks[TOPIC + "/set/#"](client, None, types.SimpleNamespace(topic=TOPIC + "/set/" + path, payload=payload, retain=retain))
+        driver.GLib.run_pending()
+        acks = [(topic[len(TOPIC + "/ack/"):], driver.loads(payload)) for topic, payload, _ in client.messages if topic.startswith(TOPIC + "/ack/")]
+        client.messages.clear()
+        return acks
+
+    return send
+
+
+def test_command_applied(commands):
+    assert commands(("Info/MaxChargeCurrent", b"50")) == [("Info/MaxChargeCurrent", {"Value": 50, "Result": "ok"})]
+    assert FakeItemImport.writes == [("/Info/MaxChargeCurrent", 50)]
+
+
+def test_command_not_in_command_paths(commands):
+    assert commands(("Soc", b"100")) == [("Soc", {"Value": None, "Result": "rejected", "Message": "not in command_paths"})]
+    assert FakeItemImport.writes == []
+
+
+def test_retained_command_ignored(commands):
+    assert commands(("Info/MaxChargeCurrent", b"50"), retain=True) == []
+    assert FakeItemImport.writes == []
+
+
+@pytest.mark.parametrize("payload", [b"NaN", b"Infinity", b"-Infinity", b"true", b"\"50\"", b"abc", b""])
+def test_command_not_a_number(driver, commands, monkeypatch, payload):
+    # json.loads is used, if orjson is not installed, and accepts NaN and Infinity
+    monkeypatch.setattr(driver, "loads", json.loads)
+    assert commands(("Info/MaxChargeCurrent", payload)) == [("Info/MaxChargeCurrent", {"Value": None, "Result": "rejected", "Message": "not a number"})]
+    assert FakeItemImport.writes == []
+
+
+def test_last_value_wins(commands):
+    assert commands(("Info/MaxChargeCurrent", b"10"), ("Info/MaxChargeCurrent", b"20")) == [("Info/MaxChargeCurrent", {"Value": 20, "Result": "ok"})]
+    assert FakeItemImport.writes == [("/Info/MaxChargeCurrent", 20)]
+
+
+def test_rate_limit(commands):
+    commands(("Info/MaxChargeCurrent", b"10"))
+    assert commands(("Info/MaxChargeCurrent", b"20")) == [
+        ("Info/MaxChargeCurrent", {"Value": 20, "Result": "rate_limited", "Message": "less than 1 seconds since the last write"})
+    ]
+    assert FakeItemImport.writes == [("/Info/MaxChargeCurrent", 10)]
+
+
+def test_command_not_accepted(commands, monkeypatch):
+    monkeypatch.setattr(FakeItemImport, "result", 1)
+    assert commands(("Info/MaxChargeCurrent", b"50")) == [("Info/MaxChargeCurrent", {"Value": 50, "Result": "error", "Message": "SetValue returned 1"})]
+
+
+def test_command_dbus_error(driver, commands, monkeypatch):
+    monkeypatch.setattr(FakeItemImport, "result", driver.dbus.exceptions.DBusException("no such path"))
+    [(path, ack)] = commands(("Info/MaxChargeCurrent", b"50"))
+    assert path == "Info/MaxChargeCurrent"
+    assert ack["Value"] == 50 and ack["Result"] == "error"
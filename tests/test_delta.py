@@ -0,0 +1,53 @@
+# Delta mode: only the values, which changed more than their deadband, the full JSON is the only retained payload
+
+from conftest import GET_ITEMS, TOPIC
+
+
+def test_is_changed(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "delta_deadbands", {"Dc/Power": (10.0, False), "Soc": (5.0, True)})
+    service, _, _ = glib_battery(connected=False)
+    published = {"Dc/Power": 100.0, "Soc": 80, "Dc/Voltage": 53.2, "Info/Name": "JBD"}
+
+    # not published yet
+    assert service._is_changed("Dc/Current", 1.0, published)
+    # absolute deadband, the change has to be larger
+    assert not service._is_changed("Dc/Power", 110.0, published)
+    assert service._is_changed("Dc/Power", 110.5, published)
+    assert service._is_changed("Dc/Power", 89.0, published)
+    # relative deadband in percent of the last published value
+    assert not service._is_changed("Soc", 84, published)
+    assert service._is_changed("Soc", 85, published)
+    # without deadband every change counts
+    assert service._is_changed("Dc/Voltage", 53.21, published)
+    assert not service._is_changed("Dc/Voltage", 53.2, published)
+    # values which are no numbers are compared as they are
+    assert service._is_changed("Info/Name", "LLT", published)
+    monkeypatch.setitem(driver.delta_deadbands, "Info/Name", (10.0, False))
+    assert not service._is_changed("Info/Name", "JBD", published)
+
+
+def test_delta_publish(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "delta_enabled", True)
+    monkeypatch.setattr(driver, "mqtt_retain", True)
+    monkeypatch.setattr(driver, "delta_deadbands", {"Dc/Power": (10.0, False)})
+    service, dbus_conn, client = glib_battery(items=dict(GET_ITEMS))
+    assert [(topic, retain) for topic, _, retain in client.messages] == [(TOPIC, True), (TOPIC + "/Status", True)]
+    client.messages.clear()
+
+    # inside the deadband, nothing is published
+    dbus_conn.receivers["PropertiesChanged"]({"Value": 125.0}, path="/Dc/0/Power")
+    driver.GLib.run_pending()
+    assert client.messages == []
+
+    # the change is measured against the last published value, deltas are not retained
+    dbus_conn.receivers["ItemsChanged"]({"/Dc/0/Power": {"Value": 131.0}, "/Soc": {"Value": 80}})
+    driver.GLib.run_pending()
+    assert client.messages == [(TOPIC, '{"Dc":{"Power":131.0},"Soc":80}', False)]
+
+    # the periodic full JSON reads the whole battery again and is retained
+    client.messages.clear()
+    dbus_conn.items["/Dc/0/Power"] = 131.0
+    service._full_snapshot_timer()
+    driver.GLib.run_pending()
+    assert [(topic, retain) for topic, _, retain in client.messages] == [(TOPIC, True)]
+    assert driver.loads(client.messages[0][1])["Dc"]["Power"] == 131.0
@@ -0,0 +1,100 @@
+# Parity of the GLib and the asyncio engine of dbus-mqtt-battery-sender
+# Both engines get the same GetItems, ItemsChanged and PropertiesChanged input and have to publish the same messages.
+
+import asyncio
+
+from conftest import GET_ITEMS, TOPIC, FakeAsyncMqttClient, Variant
+
+ITEMS_CHANGED = {
+    "/Dc/0/Power": -40.0,
+    "/Dc/0/Current": -0.8,
+    "/Voltages/Cell2": 3.329,
+    "/Serial": "still skipped",
+}
+
+PROPERTIES_CHANGED = ("/Soc", 80)
+
+
+def run_glib_engine(driver, glib_battery):
+    _, dbus_conn, client = glib_battery()
+
+    dbus_conn.receivers["ItemsChanged"]({path: {"Value": value, "Text": str(value)} for path, value in ITEMS_CHANGED.items()})
+    driver.GLib.run_pending()
+
+    path, value = PROPERTIES_CHANGED
+    dbus_conn.receivers["PropertiesChanged"]({"Value": value, "Text": str(value)}, path=path)
+    driver.GLib.run_pending()
+    return client.messages
+
+
+def run_asyncio_engine(driver):
+    async def run():
+        engine = driver.AsyncEngine(driver.JsonSerializer())
+        client = FakeAsyncMqttClient()
+        engine._mqtt = client
+
+        async def call(destination, path, interface, member, signature="", body=None):
+            assert member == "GetItems"
+            return [{path: {"Value": Variant(value), "Text": Variant(str(value))} for path, value in GET_ITEMS.items()}]
+
+        async def call_bus(member, signature="", body=None):
+            return [":1.42"] if member == "GetNameOwner" else []
+
+        engine.call = call
+        engine.call_bus = call_bus
+        sender = driver.AsyncBatterySender("test", TOPIC, engine)
+
+        async def settle():
+            for _ in range(10):
+                await asyncio.sleep(0)
+
+        await sender.start()
+        await settle()
+
+        sender.on_items_changed({path: {"Value": Variant(value), "Text": Variant(str(value))} for path, value in ITEMS_CHANGED.items()})
+        await settle()
+
+        path, value = PROPERTIES_CHANGED
+        sender.on_properties_changed(path, {"Value": Variant(value), "Text": Variant(str(value))})
+        await settle()
+
+        await sender.stop()
+        return client.messages
+
+    return asyncio.run(run())
+
+
+def test_same_messages(driver, glib_battery):
+    glib_messages = run_glib_engine(driver, glib_battery)
+    asyncio_messages = run_asyncio_engine(driver)
+
+    # initial full JSON with the status, the batched change and the single change
+    assert [topic for topic, _, _ in glib_messages] == [TOPIC, TOPIC + "/Status", TOPIC, TOPIC]
+    assert asyncio_messages == glib_messages
+
+
+def test_same_payload(driver):
+    payload = driver.build_payload({path.lstrip("/"): value for path, value in GET_ITEMS.items()})
+
+    assert driver.loads(driver.JsonSerializer().serialize(payload)) == {
+        "Dc": {"Power": 120.5, "Voltage": 53.2, "Current": 2.3},
+        "Soc": 81,
+        "Voltages": {"Cell1": 3.325, "Cell2": 3.327},
+        "System": {"MinCellVoltage": 3.325},
+        "Alarms": {"LowVoltage": 0},
+    }
+    assert driver.is_complete(payload, TOPIC)
+
+
+def test_asyncio_publishes_are_tracked(driver):
+    driver.publish_tracker.process()
+    published = driver.publish_tracker.published
+    acknowledged = driver.publish_tracker.acknowledged
+    run_asyncio_engine(driver)
+
+    # the acknowledges are counted in the event loop, like in the GLib main loop
+    driver.publish_tracker.process()
+    values = driver.metrics.get_values()
+    assert values["published"] == published + 4
+    assert values["publish_acknowledged"] == acknowledged + 4
+    assert values["publish_queue_depth"] == 0
@@ -0,0 +1,41 @@
+# Keepalive of the event mode: only the full JSON on the payload topic and only after keepalive_interval without a publish
+
+from conftest import TOPIC
+
+
+def test_keepalive_only_when_idle(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "keepalive_interval", 15)
+    service, _, client = glib_battery()
+    client.messages.clear()
+
+    # published just now
+    service._keepalive_timer()
+    assert client.messages == []
+    assert driver.GLib.timers[-1][0] == 15
+
+    service._last_publish -= 20
+    service._keepalive_timer()
+    assert [topic for topic, _, _ in client.messages] == [TOPIC]
+    assert driver.GLib.timers[-1][0] == 15
+
+
+def test_keepalive_skips_fanout_and_delta(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "keepalive_interval", 15)
+    monkeypatch.setattr(driver, "delta_enabled", True)
+    monkeypatch.setattr(driver, "fanout_enabled", True)
+    service, dbus_conn, client = glib_battery()
+    fanout_published = dict(service._fanout_published)
+    assert fanout_published
+    client.messages.clear()
+
+    service._last_publish -= 20
+    service._keepalive_timer()
+    assert [topic for topic, _, _ in client.messages] == [TOPIC]
+    assert service._fanout_published == fanout_published
+    assert not service._full_pending
+
+    # the next change is sent as delta and as its fanout leaf only
+    client.messages.clear()
+    dbus_conn.receivers["PropertiesChanged"]({"Value": 80}, path="/Soc")
+    driver.GLib.run_pending()
+    assert [(topic, payload) for topic, payload, _ in client.messages] == [(TOPIC + "/Soc", "80"), (TOPIC, '{"Soc":80}')]
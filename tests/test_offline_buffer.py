@@ -0,0 +1,94 @@
+# Offline buffer: samples collected while the broker is not reachable and replayed to <topic>/history
+
+import pytest
+
+from conftest import TOPIC
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(driver, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(driver, "time", clock)
+    return clock
+
+
+def test_interval(driver, clock):
+    buffer = driver.OfflineBuffer(size=10, max_age=3600, interval=10)
+    buffer.add({"Soc": 1})
+    clock.now += 5
+    buffer.add({"Soc": 2})
+    clock.now += 5
+    buffer.add({"Soc": 3})
+    assert buffer.get() == [(1000.0, {"Soc": 1}), (1010.0, {"Soc": 3})]
+
+
+def test_downsampling(driver, clock):
+    buffer = driver.OfflineBuffer(size=4, max_age=3600, interval=0)
+    for soc in range(6):
+        buffer.add({"Soc": soc})
+        clock.now += 1
+
+    # the older half keeps every second sample, so the whole outage stays covered
+    assert len(buffer) == 4
+    assert [sample["Soc"] for _, sample in buffer.get()] == [0, 3, 4, 5]
+
+
+def test_max_age_and_remove(driver, clock):
+    buffer = driver.OfflineBuffer(size=10, max_age=60, interval=0)
+    for soc in range(3):
+        buffer.add({"Soc": soc})
+        clock.now += 25
+
+    # the first sample is older than max_age
+    assert [sample["Soc"] for _, sample in buffer.get()] == [1, 2]
+    # the oldest samples are removed, also the one which is too old
+    buffer.remove(2)
+    assert [sample["Soc"] for _, sample in buffer.get()] == [2]
+    buffer.clear()
+    assert len(buffer) == 0
+
+
+def test_file(driver, clock, tmp_path):
+    file = str(tmp_path / "buffer" / "test.jsonl")
+    buffer = driver.OfflineBuffer(size=10, max_age=3600, interval=0, file=file)
+    buffer.add({"Soc": 1})
+    clock.now += 1
+    buffer.add({"Soc": 2})
+    buffer.remove(0)
+
+    # loaded again after a restart of the driver
+    assert driver.OfflineBuffer(size=10, max_age=3600, interval=0, file=file).get() == [(1000.0, {"Soc": 1}), (1001.0, {"Soc": 2})]
+
+    buffer.clear()
+    assert not (tmp_path / "buffer" / "test.jsonl").exists()
+
+
+def test_replay(driver, glib_battery, clock, monkeypatch):
+    monkeypatch.setattr(driver, "offline_buffer_size", 10)
+    monkeypatch.setattr(driver, "offline_buffer_interval", 0)
+    monkeypatch.setattr(driver, "offline_buffer_path", None)
+    service, dbus_conn, client = glib_battery(connected=False)
+    clock.now += 1
+    dbus_conn.receivers["PropertiesChanged"]({"Value": 80}, path="/Soc")
+    driver.GLib.run_pending()
+    assert client.messages == []
+
+    driver.connected.set()
+    clock.now += 1
+    dbus_conn.receivers["PropertiesChanged"]({"Value": 79}, path="/Soc")
+    driver.GLib.run_pending()
+
+    # the buffered samples first, not retained and with their time, then the current values
+    history = [(topic, driver.loads(payload)["Soc"], driver.loads(payload)["Timestamp"], retain) for topic, payload, retain in client.messages if topic == TOPIC + "/history"]
+    assert history == [(TOPIC + "/history", 81, 1000, False), (TOPIC + "/history", 80, 1001, False)]
+    assert client.messages[2][0] == TOPIC
+    assert driver.loads(client.messages[2][1])["Soc"] == 79
+    assert len(service._offline_buffer) == 0
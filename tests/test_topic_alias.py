@@ -0,0 +1,21 @@
+# MQTT 5.0 topic alias of the payload topic
+
+from conftest import TOPIC
+
+
+def test_topic_alias_per_topic(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "mqtt_v5", True)
+    monkeypatch.setattr(driver, "mqtt_topic_alias", True)
+    monkeypatch.setattr(driver, "mqtt_topic_aliases", {})
+    # paho.mqtt.properties is not needed for the alias numbers
+    monkeypatch.setattr(driver.DbusMqttBatterySenderService, "_create_properties", lambda self, message_expiry=0, topic_alias=None: topic_alias)
+
+    first, _, _ = glib_battery(connected=False)
+    second, _, _ = glib_battery(connected=False, battery_path="test2", mqtt_topic=TOPIC + "2")
+    assert (first._topic_alias, second._topic_alias) == (1, 2)
+
+    # a battery, which is removed and found again, keeps its alias
+    first.stop()
+    again, _, _ = glib_battery(connected=False)
+    assert again._topic_alias == 1
+    assert driver.mqtt_topic_aliases == {TOPIC: 1, TOPIC + "2": 2}
@@ -0,0 +1,87 @@
+# unwrap_dbus_value of the vendored velib_python has to return the same values as the original implementation
+
+import sys
+from array import array
+
+import pytest
+
+
+def unwrap_dbus_value_original(val):
+    # velib_python before the lookup by type, only the dbus module is passed in
+    dbus = sys.modules["dbus"]
+    dbus_int_types = (dbus.Int32, dbus.UInt32, dbus.Byte, dbus.Int16, dbus.UInt16, dbus.UInt32, dbus.Int64, dbus.UInt64)
+    if isinstance(val, dbus_int_types):
+        return int(val)
+    if isinstance(val, dbus.Double):
+        return float(val)
+    if isinstance(val, dbus.Array):
+        v = [unwrap_dbus_value_original(x) for x in val]
+        return None if len(v) == 0 else v
+    if isinstance(val, (dbus.Signature, dbus.String)):
+        return str(val)
+    if isinstance(val, dbus.Byte):
+        return int(val)
+    if isinstance(val, dbus.ByteArray):
+        return "".join([bytes(x) for x in val])
+    if isinstance(val, (list, tuple)):
+        return [unwrap_dbus_value_original(x) for x in val]
+    if isinstance(val, (dbus.Dictionary, dict)):
+        return dict([(x, unwrap_dbus_value_original(y)) for x, y in val.items()])
+    if isinstance(val, dbus.Boolean):
+        return bool(val)
+    return val
+
+
+def assert_same(value, expected):
+    # equal and of the same type, also in lists and dicts, so 1 and True or 1 and 1.0 are different
+    assert type(value) is type(expected), (value, expected)
+    if isinstance(expected, list):
+        assert len(value) == len(expected)
+        for x, y in zip(value, expected):
+            assert_same(x, y)
+    elif isinstance(expected, dict):
+        assert value.keys() == expected.keys()
+        for key in expected:
+            assert_same(value[key], expected[key])
+    else:
+        assert value == expected
+
+
+def get_values(dbus):
+    return [
+        dbus.Int16(-3), dbus.UInt16(3), dbus.Int32(-70000), dbus.UInt32(70000), dbus.Int64(-2**40), dbus.UInt64(2**40), dbus.Byte(84),
+        dbus.Double(3.325), dbus.Boolean(True), dbus.Boolean(False), dbus.String("JBD"), dbus.Signature("a{sv}"),
+        1, 2.5, True, "text", None,
+        dbus.Array([], signature=dbus.Signature("i")),
+        dbus.Array([dbus.Int32(1), dbus.Double(2.5), dbus.String("x")], signature=dbus.Signature("v")),
+        dbus.Array([dbus.Array([], signature=dbus.Signature("i")), dbus.Array([dbus.Boolean(True)], signature=dbus.Signature("b"))], signature=dbus.Signature("av")),
+        [dbus.Int32(1), (dbus.Double(2.0), dbus.String("y"))],
+        dbus.Dictionary({"Soc": dbus.Double(81.0), "Alarm": dbus.Int32(0), "Invalid": dbus.Array([], signature=dbus.Signature("i"))}, signature=dbus.Signature("sv")),
+        {"Dc/0/Power": dbus.Double(120.5), "Info": dbus.Dictionary({"MaxChargeCurrent": dbus.Int32(50), "Flag": dbus.Boolean(False)}, signature=dbus.Signature("sv"))},
+    ]
+
+
+@pytest.fixture
+def ve_utils(driver):
+    # imported by the driver from ext/velib_python
+    return sys.modules["ve_utils"]
+
+
+def test_unwrap_dbus_value_unchanged(ve_utils):
+    for value in get_values(sys.modules["dbus"]):
+        assert_same(ve_utils.unwrap_dbus_value(value), unwrap_dbus_value_original(value))
+
+
+def test_unwrap_dbus_value_numeric_arrays(ve_utils):
+    dbus = sys.modules["dbus"]
+    # arrays of numbers are returned as array("d") with the same values
+    numbers = dbus.Array([dbus.Double(3.325), dbus.Double(3.327)], signature=dbus.Signature("d"))
+    assert ve_utils.unwrap_dbus_value(numbers, numeric_arrays=True) == array("d", [3.325, 3.327])
+    integers = dbus.Array([dbus.Int32(1), dbus.Int32(2)], signature=dbus.Signature("i"))
+    assert ve_utils.unwrap_dbus_value(integers, numeric_arrays=True) == array("d", [1, 2])
+
+    # empty arrays stay invalid and all other values are unchanged
+    assert ve_utils.unwrap_dbus_value(dbus.Array([], signature=dbus.Signature("d")), numeric_arrays=True) is None
+    for value in get_values(dbus):
+        if not (isinstance(value, dbus.Array) and value.signature in ("d", "i")):
+            assert_same(ve_utils.unwrap_dbus_value(value, numeric_arrays=True), unwrap_dbus_value_original(value))
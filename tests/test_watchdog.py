@@ -0,0 +1,24 @@
+# Stale marker of the watchdog
+
+from conftest import TOPIC
+
+
+def test_publish_stale_removes_retained_payload(driver, glib_battery, monkeypatch):
+    monkeypatch.setattr(driver, "mqtt_retain", True)
+    monkeypatch.setattr(driver, "fanout_enabled", True)
+    service, _, client = glib_battery()
+    assert (TOPIC + "/Soc", "81", True) in client.messages
+    client.messages.clear()
+
+    service.publish_stale()
+    assert client.messages[0:2] == [(TOPIC + "/Status", "stale", True), (TOPIC, None, True)]
+    # the retained fanout values are removed as well
+    assert (TOPIC + "/Soc", None, True) in client.messages
+
+
+def test_publish_stale_without_retain(driver, glib_battery):
+    service, _, client = glib_battery()
+    client.messages.clear()
+
+    service.publish_stale()
+    assert client.messages == [(TOPIC + "/Status", "stale", True)]